@@ -6,6 +6,11 @@ import os
 from pathlib import Path
 import logging
 import pickle
+import hashlib
+import shutil
+import json
+import functools
+import contextlib
 
 # Astropy packages
 from astropy.table import Table
@@ -17,9 +22,15 @@ n = u.def_unit('n')
 # Scipy
 import scipy
 from scipy.optimize import curve_fit
-from scipy import signal
 from scipy.interpolate import LinearNDInterpolator
+import scipy.fft
+import scipy.sparse
 
+# Optional: compiled kernels for the model flux (see model_backend)
+try:
+    import numba
+except ImportError:
+    numba = None
 
 # Matplotlib packages
 import matplotlib.pyplot as plt
@@ -33,10 +44,111 @@ os.chdir(working_directory)
 
 galah_dr4_directory = '/avatar/buder/GALAH_DR4/'
 
-def load_isochrones():
+# On-disk cache of the degradation wavelength grids (see calculate_default_degrading_wavelength_grid). Set the directory to None to disable it.
+degradation_grid_cache_directory = working_directory + 'assets/degradation_grid_cache/'
+degradation_grid_cache_max_bytes = 2 * 1024**3
+degradation_grid_cache_stats = {'hits': 0, 'misses': 0}
+
+# Precomputed broadening operators per CCD (see build_degradation_operators). Empty if the per-call degradation should be used.
+degradation_operators = dict()
+
+# Broaden all CCDs in one FFT (see build_batched_convolution) instead of one FFT per CCD. The rows of the batch are padded to the longest CCD,
+# so this only pays off with several convolution_workers threads: 1 suits the worker pool, where every core already runs a fit, -1 uses all cores within a single fit.
+batched_convolution = False
+batched_convolution_layout = None
+convolution_workers = 1
+
+# Preprocessed spectra (the output of read_spectrum), one flat .npy and a .json description per object, grouped by night. Set the directory to None to disable it.
+spectrum_store_directory = working_directory + 'assets/spectrum_store/'
+spectrum_store_version = 1
+
+# LSF information indexed by (pivot, plate, high-res, ccd), loaded on first use (see load_lsf_index)
+lsf_index = None
+
+# Resampling of the broadened spectra onto the observed wavelengths (see degrade_to_observed_wavelength_fused):
+# local Lagrange interpolation with this many grid points around each observed pixel (2 is linear), or None for a cubic spline through the whole grid
+resampling_points = 6
+
+# Renormalisation of the observed flux for each model evaluation (see renormalisation_continuum):
+# None runs sclip with chebyshev as is, 'cached' gives the same fits with the Vandermonde matrix and the least-squares solution for each clip mask reused,
+# and 'warm' additionally starts clipping from the previous evaluation's final mask
+renormalisation_mode = 'cached'
+renormalisation_states = dict()
+
+# Emulator weights and wavelength grid as memory-mapped .npy files (see load_emulator_arrays), shared by all worker processes through the page cache
+emulator_array_directory = working_directory + 'assets/emulator_arrays/'
+emulator_array_names = ['w_array_0', 'w_array_1', 'w_array_2', 'b_array_0', 'b_array_1', 'b_array_2', 'x_min', 'x_max']
+emulator_arrays = dict()
+
+# Floating-point type of the emulator evaluation, the broadening and the resampling. np.float32 halves the memory traffic of these steps;
+# wavelengths, interpolation weights and the renormalisation stay in float64. Check the deviation with validate_model_precision.
+model_precision = np.float64
+emulator_components_at_precision = dict()
+
+# Backend for the broadening, resampling and f_contr mix of the model flux (see combine_component_fluxes_compiled):
+# 'numba' runs compiled kernels on buffers preallocated per CCD, 'numpy' the array code. Without numba, 'numpy' is used.
+model_backend = 'numba'
+
+# Evaluate only the emulator pixels that the degradation operators of the current spectrum use (see prune_emulator_output), given as a list of slices of the emulator grid.
+# The observed wavelengths are covered for radial velocities within +-pruning_rv_margin km/s (or the margin passed to load_neural_network); larger ones raise a ValueError.
+pruned_emulator_output = True
+pruning_rv_margin = 1000.
+emulator_output_pixels = None
+
+# The GALAH kernels and their transforms are cached per (fwhm, b), with fwhm rounded to this many decimals (in pixels of the oversampled grid)
+galah_kern_decimals = 6
+
+@contextlib.contextmanager
+def atomic_write_directory(directory):
+    """
+    Yields a temporary directory to write into, which is renamed to directory once the block completes,
+    so that other processes never load a partially written directory. If another process has written it in the meantime, that one is kept.
+    """
+    temporary_directory = directory.rstrip('/') + '.' + str(os.getpid()) + '.tmp'
+    Path(temporary_directory).mkdir(parents=True, exist_ok=True)
+    try:
+        yield temporary_directory
+    except BaseException:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(temporary_directory, directory.rstrip('/'))
+    except OSError:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+@contextlib.contextmanager
+def atomic_write_file(path, mode='wb'):
+    """
+    Yields a temporary file to write into, which replaces path once the block completes, so that other processes never read a partially written file.
+    """
+    temporary_path = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temporary_path, mode) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    os.replace(temporary_path, path)
+
+def load_isochrones(regular_grid=True):
     global isochrone_interpolator
     working_directory = '/avatar/yanilach/PhD-Home/binaries_galah-main/spectrum_analysis/BinaryAnalysis/'
 
+    # The PARSEC isochrones are gridded in logAge and m_h, which IsochroneInterpolator uses directly. This takes seconds rather than the 20-40m of the LinearNDInterpolator.
+    # It is stored as flat .npy arrays that every process memory-maps, so all workers share one copy in the page cache.
+    if regular_grid:
+        isochrone_directory = working_directory + 'assets/parsec_interpolator/'
+        if not os.path.exists(isochrone_directory):
+            print("No compiled isochrone interpolator found. Creating it from the PARSEC table.")
+            isochrone_table = Table.read(working_directory + 'assets/parsec_isochrones_logt_8p00_0p01_10p17_mh_m2p75_0p25_m0p75_mh_m0p60_0p10_0p70_GaiaEDR3_2MASS.fits')
+            IsochroneInterpolator.from_table(isochrone_table).save(isochrone_directory)
+
+        isochrone_interpolator = IsochroneInterpolator.load(isochrone_directory)
+        return isochrone_interpolator
+
     # print(working_directory)
     if os.path.exists(working_directory + '/assets/parsec_interpolator.pkl'):
         with open(working_directory + '/assets/parsec_interpolator.pkl', 'rb') as f:
@@ -68,6 +180,126 @@ def load_isochrones():
         return isochrone_interpolator
 
 
+class IsochroneInterpolator:
+    """
+    Interpolates log(Teff), logg and log(L) of the PARSEC isochrones at (mass, log(age), m_h). Drop-in replacement for the LinearNDInterpolator.
+
+    The isochrones form a regular grid in log(age) and m_h. Each of the four isochrones around a point is interpolated linearly in mass,
+    and the results are combined bilinearly in log(age) and m_h. Points outside of the grid (or outside the mass range of an isochrone) are NaN.
+
+    All isochrones are stored in flat arrays: the rows of isochrone i are offsets[i]:offsets[i+1] of masses and values,
+    with isochrone i = age_index * len(m_hs) + m_h_index. save() writes these arrays as .npy files and load() memory-maps them.
+    """
+    array_names = ['log_ages', 'm_hs', 'offsets', 'masses', 'values', 'search_keys']
+
+    def __init__(self, log_ages, m_hs, offsets, masses, values, search_keys=None):
+        self.log_ages = log_ages
+        self.m_hs = m_hs
+        self.offsets = offsets
+        self.masses = masses
+        self.values = values
+
+        # Search keys: isochrone index plus the mass scaled into [0, 0.5], so that one searchsorted finds masses in any isochrone
+        self.mass_min = np.min(masses)
+        self.mass_scale = 0.5 / (np.max(masses) - self.mass_min)
+        if search_keys is None:
+            search_keys = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)) + (masses - self.mass_min) * self.mass_scale
+        self.search_keys = search_keys
+
+    def save(self, directory):
+        with atomic_write_directory(directory) as temporary_directory:
+            for name in self.array_names:
+                np.save(os.path.join(temporary_directory, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        return cls(**{name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in cls.array_names})
+
+    def get_ranges(self):
+        # Ranges covered by the isochrones, e.g. for parameter bounds
+        return {
+            'mass': (float(np.min(self.masses)), float(np.max(self.masses))),
+            'logAge': (float(self.log_ages[0]), float(self.log_ages[-1])),
+            'm_h': (float(self.m_hs[0]), float(self.m_hs[-1])),
+            'logT': (float(np.min(self.values[:, 0])), float(np.max(self.values[:, 0]))),
+            'logg': (float(np.min(self.values[:, 1])), float(np.max(self.values[:, 1]))),
+            'logL': (float(np.min(self.values[:, 2])), float(np.max(self.values[:, 2])))
+        }
+
+    @classmethod
+    def from_table(cls, isochrone_table, decimals=4):
+        # Grid values are rounded to identify the isochrones (logAge and m_h are stored as floats)
+        log_age = np.round(np.array(isochrone_table['logAge'], dtype=float), decimals)
+        m_h = np.round(np.array(isochrone_table['m_h'], dtype=float), decimals)
+        log_ages = np.unique(log_age)
+        m_hs = np.unique(m_h)
+        n_isochrones = len(log_ages) * len(m_hs)
+
+        isochrone_index = np.searchsorted(log_ages, log_age) * len(m_hs) + np.searchsorted(m_hs, m_h)
+        if len(np.unique(isochrone_index)) != n_isochrones:
+            raise ValueError('Isochrone table is not a regular grid in logAge and m_h.')
+
+        # Group the rows by isochrone, keeping their order along each isochrone
+        order = np.argsort(isochrone_index, kind='stable')
+        isochrone_index = isochrone_index[order]
+        masses = np.array(isochrone_table['mass'], dtype=float)[order]
+        values = np.array([isochrone_table['logT'], isochrone_table['logg'], isochrone_table['logL']], dtype=float).T[order]
+
+        # Mass has to increase along an isochrone for the interpolation. Drop later points where it does not (e.g. mass loss in late phases).
+        keep = np.ones(len(masses), dtype=bool)
+        boundaries = np.searchsorted(isochrone_index, np.arange(n_isochrones + 1))
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            keep[start+1:end] = masses[start+1:end] > np.maximum.accumulate(masses[start:end])[:-1]
+
+        offsets = np.searchsorted(isochrone_index[keep], np.arange(n_isochrones + 1))
+        if np.any(np.diff(offsets) < 2):
+            raise ValueError('Every isochrone needs at least two points with increasing mass.')
+
+        return cls(log_ages, m_hs, offsets, masses[keep], values[keep])
+
+    @staticmethod
+    def grid_cell(grid, x):
+        # Index of the grid cell containing x and the relative position within it (NaN outside of the grid)
+        index = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+        weight = (x - grid[index]) / (grid[index + 1] - grid[index])
+        weight[(x < grid[0]) | (x > grid[-1]) | np.isnan(x)] = np.nan
+        return index, weight
+
+    def interpolate_mass(self, isochrone, mass):
+        # Linear interpolation in mass along the given isochrones (one per point)
+        start = self.offsets[isochrone]
+        end = self.offsets[isochrone + 1]
+
+        right = np.clip(np.searchsorted(self.search_keys, isochrone + (mass - self.mass_min) * self.mass_scale, side='right'), start + 1, end - 1)
+        left = right - 1
+        weight = (mass - self.masses[left]) / (self.masses[right] - self.masses[left])
+
+        values = self.values[left] + weight[:, np.newaxis] * (self.values[right] - self.values[left])
+        values[~((mass >= self.masses[start]) & (mass <= self.masses[end - 1]))] = np.nan
+        return values
+
+    def __call__(self, mass, log_age, m_h):
+        """
+        Accepts mass, log(age) and m_h (scalars or arrays). Returns log(Teff), logg and log(L) along the last axis.
+        """
+        mass, log_age, m_h = np.broadcast_arrays(np.asarray(mass, dtype=float), np.asarray(log_age, dtype=float), np.asarray(m_h, dtype=float))
+        shape = mass.shape
+        mass, log_age, m_h = mass.ravel(), log_age.ravel(), m_h.ravel()
+
+        age_index, age_weight = self.grid_cell(self.log_ages, log_age)
+        m_h_index, m_h_weight = self.grid_cell(self.m_hs, m_h)
+
+        interpolated = np.zeros((len(mass), 3))
+        for age_corner in [0, 1]:
+            for m_h_corner in [0, 1]:
+                weight = (age_weight if age_corner else 1 - age_weight) * (m_h_weight if m_h_corner else 1 - m_h_weight)
+                isochrone = (age_index + age_corner) * len(self.m_hs) + m_h_index + m_h_corner
+                # Corners without weight are skipped, as their isochrone need not cover the mass of a point on the grid in log(age) or m_h (NaN weights outside of the grid still give NaN)
+                interpolated += np.where(weight[:, np.newaxis] == 0, 0, weight[:, np.newaxis] * self.interpolate_mass(isochrone, mass))
+
+        return interpolated.reshape(shape + (3,))
+
+
 # This is for printing only. The model has it's own code.
 def interpolate_isochrone(mass, age, m_h):
     """
@@ -95,27 +327,69 @@ def interpolate_isochrone(mass, age, m_h):
 
     return interpolated
 
-def load_neural_network(spectrum):
-    global model_name, default_wave_dir, default_model_wave, initial_l, model_components
+def load_neural_network(spectrum, build_degradation_operator=True, rv_margin=None):
+    # rv_margin: largest |rv| in km/s that the fit can reach, e.g. from the rv bounds. Defaults to pruning_rv_margin.
+    global model_name, default_wave_dir, default_model_wave, initial_l, model_components, degradation_operators, batched_convolution_layout, emulator_output_pixels, renormalisation_states
 
     # Read in neural network
     model_name = '/avatar/yanilach/PhD-Home/binaries_galah-main/spectrum_modelling/galah_parameter_nn_300_neurons_0p0001_lrate_128_batchsize_model.npz'
     default_wave_dir = '/avatar/yanilach/PhD-Home/binaries_galah-main/spectrum_modelling/galah_parameter_nn_wavelength.txt'
-    default_model_wave = np.loadtxt(default_wave_dir, dtype=float)
+
+    renormalisation_states = dict()
+
+    # Read-only views of the memory-mapped arrays. Loaded once per process and reused for every spectrum.
+    model_components, default_model_wave = load_emulator_arrays(model_name, default_wave_dir)
     initial_l = calculate_default_degrading_wavelength_grid(default_model_wave, spectrum)
 
-    tmp = np.load(model_name)
-    w_array_0 = tmp["w_array_0"]
-    w_array_1 = tmp["w_array_1"]
-    w_array_2 = tmp["w_array_2"]
-    b_array_0 = tmp["b_array_0"]
-    b_array_1 = tmp["b_array_1"]
-    b_array_2 = tmp["b_array_2"]
-    x_min = tmp["x_min"]
-    x_max = tmp["x_max"]
-    tmp.close()
+    # The interpolation onto initial_l and the convolution are the same linear map for every model of this spectrum
+    if build_degradation_operator:
+        degradation_operators = build_degradation_operators(default_model_wave, spectrum, initial_l, rv_margin=(pruning_rv_margin if rv_margin is None else rv_margin) if pruned_emulator_output else None)
+        batched_convolution_layout = build_batched_convolution(degradation_operators, spectrum['available_ccds']) if batched_convolution else None
+        emulator_output_pixels = prune_emulator_output(degradation_operators) if pruned_emulator_output else None
+    else:
+        degradation_operators = dict()
+        batched_convolution_layout = None
+        emulator_output_pixels = None
+
 
-    model_components = (w_array_0, w_array_1, w_array_2, b_array_0, b_array_1, b_array_2, x_min, x_max)
+def save_emulator_arrays(model_name, default_wave_dir, directory):
+    with atomic_write_directory(directory) as temporary_directory:
+        tmp = np.load(model_name)
+        for name in emulator_array_names:
+            np.save(os.path.join(temporary_directory, name + '.npy'), np.ascontiguousarray(tmp[name]))
+        tmp.close()
+        np.save(os.path.join(temporary_directory, 'default_model_wave.npy'), np.loadtxt(default_wave_dir, dtype=float))
+
+
+def load_emulator_arrays(model_name, default_wave_dir, mmap_mode='r'):
+    """
+    Returns the emulator components (w_array_0, w_array_1, w_array_2, b_array_0, b_array_1, b_array_2, x_min, x_max) and default_model_wave.
+
+    On first use the .npz and wavelength file are converted to .npy files in emulator_array_directory, in a subdirectory keyed by the
+    source files' names, sizes and modification times (so a retrained emulator is picked up). These are memory-mapped read-only,
+    so every process maps the same pages instead of holding a private copy. Set emulator_array_directory to None to read the .npz directly.
+    """
+    if emulator_array_directory is None:
+        tmp = np.load(model_name)
+        model_components = tuple(tmp[name] for name in emulator_array_names)
+        tmp.close()
+        return model_components, np.loadtxt(default_wave_dir, dtype=float)
+
+    fingerprint = hashlib.sha1()
+    for source in [model_name, default_wave_dir]:
+        source_stat = os.stat(source)
+        fingerprint.update((os.path.basename(source) + str(source_stat.st_size) + str(source_stat.st_mtime_ns)).encode())
+    directory = emulator_array_directory + fingerprint.hexdigest()[:16] + '/'
+
+    if directory not in emulator_arrays:
+        if not os.path.exists(directory):
+            save_emulator_arrays(model_name, default_wave_dir, directory)
+
+        model_components = tuple(np.load(directory + name + '.npy', mmap_mode=mmap_mode) for name in emulator_array_names)
+        default_model_wave = np.load(directory + 'default_model_wave.npy', mmap_mode=mmap_mode)
+        emulator_arrays[directory] = (model_components, default_model_wave)
+
+    return emulator_arrays[directory]
 
 
 def set_logging_paths(sobject_id):
@@ -137,10 +411,211 @@ def end_processing(msg):
     exit()
 
 
-def read_spectrum(sobject_id, tmass_id=None, neglect_ir_beginning=True):
+def read_spectrum(sobject_id, tmass_id=None, neglect_ir_beginning=True, load_model=True):
     """
     This reads in raw spectra from the GALAH DR4 dataset. Outputs the range of wavelengths with valid CCD data. Does NOT output the observed fluxes.
     Observed and model fluxes are determined during model fitting, as they are dependent on the model for normalisation.
+
+    The preprocessed spectrum is kept in the spectrum store (see load_stored_spectrum), so reruns skip the FITS reading and preprocessing.
+    With load_model=False the neural network is not loaded (e.g. when only prefetching spectra, or when load_neural_network is called afterwards anyway).
+    """
+    spectrum = load_stored_spectrum(sobject_id, neglect_ir_beginning)
+
+    if spectrum is None:
+        spectrum = read_spectrum_from_fits(sobject_id, neglect_ir_beginning=neglect_ir_beginning)
+        if spectrum is False:
+            return False
+        save_stored_spectrum(spectrum, neglect_ir_beginning)
+
+    if tmass_id is not None:
+        spectrum['tmass_id'] = str(tmass_id)
+
+    ###
+    # Load the neural network model here, so the user doesn't need to call it explicitly.
+    if load_model and 'model_components' not in globals():
+        load_neural_network(spectrum)
+
+    return(spectrum)
+
+
+def read_ccd_file(path):
+    """
+    Reads the primary header, counts (HDU 0), relative counts uncertainties (HDU 2) and LSF (HDU 7) of one CCD file of a spectrum.
+    The file is memory-mapped and the other HDUs are never loaded. Each array is copied once (into native byte order), so the file is closed before returning.
+    """
+    with fits.open(path, memmap=True, lazy_load_hdus=True) as fits_file:
+        header = fits_file[0].header
+        arrays = []
+        for hdu in [0, 2, 7]:
+            data = fits_file[hdu].data
+            arrays.append(np.array(data, dtype=data.dtype.newbyteorder('=')))
+            del data
+
+    return header, arrays[0], arrays[1], arrays[2]
+
+
+def load_lsf_index():
+    """
+    Loads the LSF information table once per process and indexes it by (pivot, plate, high-res, ccd).
+    Each entry is the sorted array of sobject_ids with a measured LSF in that CCD and the same resolution setup.
+    """
+    global lsf_index
+
+    if lsf_index is None:
+        lsf_info = Table.read(working_directory + 'assets/galah_dr4_lsf_info_231004.fits')
+
+        pivots = np.array(lsf_info['pivot'])
+        plates = np.array(lsf_info['plate'])
+        high_res = np.array(lsf_info['reduction_flags']) >= 262144
+        sobject_ids = np.array(lsf_info['sobject_id'])
+        res = np.array(lsf_info['res'])
+
+        index = dict()
+        for ccd in [1,2,3,4]:
+            has_res_profile = res[:,ccd-1] > 0
+            # Sort by (pivot, plate, high-res, sobject_id) and split into groups of equal (pivot, plate, high-res)
+            order = np.lexsort((sobject_ids[has_res_profile], high_res[has_res_profile], plates[has_res_profile], pivots[has_res_profile]))
+            group_pivots = pivots[has_res_profile][order]
+            group_plates = plates[has_res_profile][order]
+            group_high_res = high_res[has_res_profile][order]
+            group_sobject_ids = sobject_ids[has_res_profile][order]
+            starts = np.flatnonzero(np.concatenate([[True], (np.diff(group_pivots) != 0) | (np.diff(group_plates) != 0) | (group_high_res[1:] != group_high_res[:-1])]))
+            for start, end in zip(starts, np.append(starts[1:], len(order))):
+                # Sorted explicitly (and without duplicates), as closest_lsf_sobject_id bisects these arrays
+                index[(int(group_pivots[start]), int(group_plates[start]), bool(group_high_res[start]), ccd)] = np.unique(group_sobject_ids[start:end])
+
+        lsf_index = index
+
+    return lsf_index
+
+
+def closest_lsf_sobject_id(sobject_id, plate, resolution, ccd):
+    """
+    Returns the sobject_id of the closest observing run with the same fibre (pivot), plate and resolution setup that has a measured LSF in this CCD.
+    Of two equally close runs, the earlier one is returned, independent of the order of the LSF information table.
+    """
+    candidates = load_lsf_index().get((int(str(sobject_id)[-3:]), int(plate), resolution == 'high-res', ccd))
+    if candidates is None or len(candidates) == 0:
+        raise ValueError('No replacement LSF available for ' + str(sobject_id) + ' in CCD' + str(ccd))
+
+    # Bisect the sorted sobject_ids. For equal distances the earlier run is taken.
+    position = np.searchsorted(candidates, sobject_id)
+    if position == len(candidates):
+        return candidates[-1]
+    if position == 0 or abs(candidates[position] - sobject_id) < abs(sobject_id - candidates[position - 1]):
+        return candidates[position]
+    return candidates[position - 1]
+
+
+@functools.lru_cache(maxsize=512)
+def read_replacement_lsf(sobject_id, ccd):
+    """
+    Reads the LSF and LSF-B of another observation, cached because many spectra on the same plate fall back to the same run.
+    The array is read-only, as it is shared between spectra.
+    """
+    with fits.open(galah_dr4_directory+'observations/'+str(sobject_id)[:6]+'/spectra/com/'+str(sobject_id)+str(ccd)+'.fits', memmap=True, lazy_load_hdus=True) as lsf_replacement_fits_file:
+        lsf_b = lsf_replacement_fits_file[0].header['B']
+        data = lsf_replacement_fits_file[7].data
+        lsf = np.array(data, dtype=data.dtype.newbyteorder('='))
+        del data
+
+    lsf.flags.writeable = False
+    return lsf_b, lsf
+
+
+def spectrum_source_files(sobject_id):
+    return [galah_dr4_directory + 'observations/' + str(sobject_id)[:6] + '/spectra/com/' + str(sobject_id) + str(ccd) + '.fits' for ccd in [1,2,3,4]]
+
+
+def source_modification_times(sobject_id):
+    # Missing CCD files are recorded as None, so that a CCD appearing later also invalidates the stored spectrum
+    modification_times = []
+    for source in spectrum_source_files(sobject_id):
+        try:
+            modification_times.append(os.stat(source).st_mtime_ns)
+        except OSError:
+            modification_times.append(None)
+    return modification_times
+
+
+def stored_spectrum_path(sobject_id, neglect_ir_beginning=True):
+    suffix = '' if neglect_ir_beginning else '_full_ccd4'
+    return os.path.join(spectrum_store_directory, str(sobject_id)[:6], str(sobject_id) + suffix)
+
+
+def save_stored_spectrum(spectrum, neglect_ir_beginning=True):
+    """
+    Stores the arrays of a preprocessed spectrum as one flat byte array (each array keeping its dtype, aligned to 8 bytes) in a .npy file,
+    and the other entries, the array layout and the modification times of the source FITS files in a .json file.
+    """
+    if spectrum_store_directory is None:
+        return
+
+    path = stored_spectrum_path(spectrum['sobject_id'], neglect_ir_beginning)
+    description = {
+        'version': spectrum_store_version,
+        'neglect_ir_beginning': bool(neglect_ir_beginning),
+        'source_modification_times': source_modification_times(spectrum['sobject_id']),
+        'arrays': {},
+        'values': {}
+    }
+
+    segments = []
+    offset = 0
+    for key, value in spectrum.items():
+        if key == 'tmass_id':
+            continue
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            description['arrays'][key] = {'offset': offset, 'dtype': value.dtype.str, 'shape': list(value.shape)}
+            segments.append(value.view(np.uint8).ravel())
+            padding = -value.nbytes % 8
+            segments.append(np.zeros(padding, dtype=np.uint8))
+            offset += value.nbytes + padding
+        else:
+            description['values'][key] = value.item() if isinstance(value, np.generic) else value
+
+    # The .json is written last, so a spectrum is only found once both files are complete
+    try:
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        with atomic_write_file(path + '.npy') as f:
+            np.save(f, np.concatenate(segments) if segments else np.zeros(0, dtype=np.uint8))
+        with atomic_write_file(path + '.json', mode='w') as f:
+            json.dump(description, f, default=lambda value: value.item())
+    except OSError as e:
+        print('Could not store preprocessed spectrum ' + str(spectrum['sobject_id']) + ': ' + str(e))
+
+
+def load_stored_spectrum(sobject_id, neglect_ir_beginning=True, mmap_mode='r'):
+    """
+    Returns the preprocessed spectrum from the spectrum store, or None if it is not stored or the source FITS files have changed since.
+    The arrays are read-only views of one memory-mapped file, so each spectrum is read with one sequential read.
+    """
+    if spectrum_store_directory is None:
+        return None
+
+    path = stored_spectrum_path(sobject_id, neglect_ir_beginning)
+    try:
+        with open(path + '.json', 'r') as f:
+            description = json.load(f)
+        if description['version'] != spectrum_store_version or description['source_modification_times'] != source_modification_times(sobject_id):
+            return None
+        data = np.load(path + '.npy', mmap_mode=mmap_mode)
+    except (OSError, ValueError, KeyError):
+        return None
+
+    spectrum = dict(description['values'])
+    for key, layout in description['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        size = int(np.prod(layout['shape'])) * dtype.itemsize
+        spectrum[key] = data[layout['offset']:layout['offset'] + size].view(dtype).reshape(layout['shape'])
+
+    return spectrum
+
+
+def read_spectrum_from_fits(sobject_id, tmass_id=None, neglect_ir_beginning=True):
+    """
+    Reads and preprocesses the spectrum from the GALAH DR4 FITS files (see read_spectrum).
     """
 
     spectrum = dict()
@@ -166,7 +641,8 @@ def read_spectrum(sobject_id, tmass_id=None, neglect_ir_beginning=True):
     dir = galah_dr4_directory + 'observations/' + str(sobject_id)[:6] + '/spectra/com/' + str(sobject_id) + '1.fits'
     try:
         if os.path.exists(dir):
-            fits_file = fits.open(dir)
+            ccd1_file = read_ccd_file(dir)
+            header = ccd1_file[0]
             # print("Succsefully found file for object " + dir)
         else:
             print("No file found for spectra ", dir)
@@ -180,19 +656,19 @@ def read_spectrum(sobject_id, tmass_id=None, neglect_ir_beginning=True):
     
 
 
-    if fits_file[0].header['SLITMASK'] in ['IN','IN      ']:
+    if header['SLITMASK'] in ['IN','IN      ']:
         spectrum['resolution'] = 'high-res'
         print('Warning: Spectrum is high-resolution!')
     else:
         spectrum['resolution'] = 'low-res'
 
-    if fits_file[0].header['WAV_OK']==0:
+    if header['WAV_OK']==0:
         print('Warning: Wavelength solution not ok!')
 
-    if fits_file[0].header['CROSS_OK']==0:
+    if header['CROSS_OK']==0:
         print('Warning: Cross-talk not calculated reliably!')
 
-    spectrum['plate'] = int(fits_file[0].header['PLATE'])
+    spectrum['plate'] = int(header['PLATE'])
     
     # This is a test if the CCD is actually available. For 181221001601377, CCD4 is missing for example.
     # We therefore implement a keyword 'available_ccds' to trigger only to loop over the available CCDs
@@ -208,25 +684,27 @@ def read_spectrum(sobject_id, tmass_id=None, neglect_ir_beginning=True):
             # counts_unc (unnormalised flux uncertainty)
             # sky
             
-            if ccd != 1:
-                fits_file = fits.open(galah_dr4_directory+'observations/'+str(sobject_id)[:6]+'/spectra/com/'+str(sobject_id)+str(ccd)+'.fits')
+            if ccd == 1:
+                header, counts, counts_relative_uncertainty, lsf = ccd1_file
+            else:
+                header, counts, counts_relative_uncertainty, lsf = read_ccd_file(galah_dr4_directory+'observations/'+str(sobject_id)[:6]+'/spectra/com/'+str(sobject_id)+str(ccd)+'.fits')
 
-            spectrum['crval_ccd'+str(ccd)] = fits_file[0].header['CRVAL1']
-            spectrum['cdelt_ccd'+str(ccd)] = fits_file[0].header['CDELT1']
+            spectrum['crval_ccd'+str(ccd)] = header['CRVAL1']
+            spectrum['cdelt_ccd'+str(ccd)] = header['CDELT1']
 
-            spectrum['counts_ccd'+str(ccd)]   = fits_file[0].data
-            counts_relative_uncertainty = fits_file[2].data
+            spectrum['counts_ccd'+str(ccd)]   = counts
 
             bad_counts_unc = np.where(~(counts_relative_uncertainty > 0) == True)[0]
             if len(bad_counts_unc) > 0:
                 print('Relative counts uncertainties <= 0 detected for '+str(len(bad_counts_unc))+' pixels in CCD'+str(ccd)+', setting to 0.1 (SNR~10)')
                 counts_relative_uncertainty[bad_counts_unc] = 0.1
 
-            spectrum['counts_unc_ccd'+str(ccd)] = counts_relative_uncertainty * fits_file[0].data
+            # The relative uncertainties are not needed afterwards, so their array becomes the absolute uncertainties
+            spectrum['counts_unc_ccd'+str(ccd)] = np.multiply(counts_relative_uncertainty, counts, out=counts_relative_uncertainty)
 
-            # Read out the line-spread-function; if it is not available, fits_file[7].data will be [0]
-            spectrum['lsf_b_ccd'+str(ccd)] = fits_file[0].header['B']
-            spectrum['lsf_ccd'+str(ccd)]   = fits_file[7].data
+            # Read out the line-spread-function; if it is not available, the data of HDU 7 will be [0]
+            spectrum['lsf_b_ccd'+str(ccd)] = header['B']
+            spectrum['lsf_ccd'+str(ccd)]   = lsf
 
             spectrum['available_ccds'].append(ccd)
         except:
@@ -239,51 +717,24 @@ def read_spectrum(sobject_id, tmass_id=None, neglect_ir_beginning=True):
             
             if np.shape(spectrum['lsf_ccd'+str(ccd)])[0] == 1:
                 
-                lsf_info = Table.read(working_directory + 'assets/galah_dr4_lsf_info_231004.fits')
-
                 # find all spectra are
                 # a) observed with same FIBRE (*pivot*) and
                 # b) observed with the same PLATE (*plate*) 
                 # c) have a measured LSF in the particular CCD
                 # d) have the same resolution setup (low- or high-res)
-                if spectrum['resolution'] != 'high-res':
-                    same_fibre_plate_ccd_and_has_res_profile = np.where(
-                        (
-                            (int(str(spectrum['sobject_id'])[-3:]) == lsf_info['pivot']) & 
-                            (spectrum['plate'] == lsf_info['plate']) &
-                            (lsf_info['res'][:,ccd-1] > 0) & 
-                            (lsf_info['reduction_flags'] < 262144)
-                        )==True)[0]
-                else:
-                    same_fibre_plate_ccd_and_has_res_profile = np.where(
-                        (
-                            (int(str(spectrum['sobject_id'])[-3:]) == lsf_info['pivot']) & 
-                            (spectrum['plate'] == lsf_info['plate']) &
-                            (lsf_info['res'][:,ccd-1] > 0) & 
-                            (lsf_info['reduction_flags'] >= 262144)
-                        )==True)[0]
-
-                # Difference between observing runs == abs(sobject_id - all possible sobject_ids)
-                sobject_id_differences = np.abs(spectrum['sobject_id'] - lsf_info['sobject_id'][same_fibre_plate_ccd_and_has_res_profile])
-                # Now find the closest observing run
-                closest_valid_sobject_id_index = np.argmin(sobject_id_differences)
-                closest_valid_sobject_id = lsf_info['sobject_id'][same_fibre_plate_ccd_and_has_res_profile][closest_valid_sobject_id_index]
+                # and take the closest observing run, i.e. the smallest abs(sobject_id - all possible sobject_ids) (see closest_lsf_sobject_id)
+                closest_valid_sobject_id = closest_lsf_sobject_id(spectrum['sobject_id'], spectrum['plate'], spectrum['resolution'], ccd)
 
                 # replace the relevant LSF for the pixels.
                 # Basically assume the LSF between the sobject_ids is the same.
                 # This should be reasonable assumption for a stable instrument like HERMES.
-                lsf_replacement_fits_file = fits.open(galah_dr4_directory+'observations/'+str(closest_valid_sobject_id)[:6]+'/spectra/com/'+str(closest_valid_sobject_id)+str(ccd)+'.fits')
-                spectrum['lsf_b_ccd'+str(ccd)] = lsf_replacement_fits_file[0].header['B']
-                spectrum['lsf_ccd'+str(ccd)]   = lsf_replacement_fits_file[7].data
-                lsf_replacement_fits_file.close()
+                spectrum['lsf_b_ccd'+str(ccd)], spectrum['lsf_ccd'+str(ccd)] = read_replacement_lsf(int(closest_valid_sobject_id), ccd)
 
                 print('No LSF reported for CCD'+str(ccd)+'. Replaced LSF and LSF-B for CCD '+str(ccd)+' with profile from '+str(closest_valid_sobject_id))
 
             zero_or_negative_flux = np.where(~(spectrum['counts_ccd'+str(ccd)] > 0))
             if len(zero_or_negative_flux) > 10:
                 print('Missing/negative flux in more than 10 pixels')
-                    
-        fits_file.close()
 
         # We know that the telluric correction for the first half of CCD4 often is bad.
         # This is caused by strong telluric molecular features below 7680 Å.
@@ -340,23 +791,110 @@ def read_spectrum(sobject_id, tmass_id=None, neglect_ir_beginning=True):
         spectrum['wave_ccd'+str(ccd)] = spectrum['crval_ccd'+str(ccd)] + spectrum['cdelt_ccd'+str(ccd)]*np.arange(len(spectrum['counts_ccd'+str(ccd)]))
     spectrum['wave'] = np.concatenate(([spectrum['wave_ccd'+str(ccd)] for ccd in spectrum['available_ccds']]))
 
-    ###
-    # Load the neural network model here, so the user doesn't need to call it explicitly.
-    if 'model_components' not in globals():
-        load_neural_network(spectrum)
-
     return(spectrum)
 
 
 def leaky_relu(z):
     return z*(z > 0) + 0.01*z*(z < 0)
 
+def leaky_relu_derivative(z):
+    return 1.0*(z > 0) + 0.01*(z < 0)
+
+def at_model_precision(arrays, name):
+    """
+    Returns arrays[name] (real or complex) in model_precision. Conversions are kept in arrays under name + '_' + the precision, e.g. for the degradation operators.
+    """
+    if model_precision == np.float64:
+        return arrays[name]
+
+    key = name + '_' + np.dtype(model_precision).name
+    if key not in arrays:
+        complex_precision = np.result_type(model_precision, np.complex64)
+        arrays[key] = arrays[name].astype(complex_precision if np.iscomplexobj(arrays[name]) else model_precision)
+    return arrays[key]
+
+def emulator_components(pruned=True):
+    """
+    model_components in model_precision. With pruned=True and emulator_output_pixels set, w_array_2 and b_array_2 are lists with the row blocks of these pixels (see output_layer).
+    The blocks are views, so the memory-mapped weights stay shared between the processes; only a conversion to another precision copies them (once per emulator, precision and set of output pixels).
+    """
+    output_pixels = emulator_output_pixels if pruned else None
+    if model_precision == np.float64 and output_pixels is None:
+        return model_components
+
+    # Keyed by the identity of the arrays, which changes whenever another emulator or spectrum is loaded
+    key = (id(model_components[0]), np.dtype(model_precision).name, id(output_pixels))
+    if key not in emulator_components_at_precision:
+        emulator_components_at_precision.clear()
+        w_array_0, w_array_1, w_array_2, b_array_0, b_array_1, b_array_2, x_min, x_max = model_components
+        if output_pixels is not None:
+            w_array_2 = [np.asarray(w_array_2[pixels], dtype=model_precision) for pixels in output_pixels]
+            b_array_2 = [np.asarray(b_array_2[pixels], dtype=model_precision) for pixels in output_pixels]
+        else:
+            w_array_2, b_array_2 = np.asarray(w_array_2, dtype=model_precision), np.asarray(b_array_2, dtype=model_precision)
+        components = tuple(np.asarray(component, dtype=model_precision) for component in (w_array_0, w_array_1)) + (w_array_2,) \
+            + tuple(np.asarray(component, dtype=model_precision) for component in (b_array_0, b_array_1)) + (b_array_2,) \
+            + tuple(np.asarray(component, dtype=model_precision) for component in (x_min, x_max))
+        emulator_components_at_precision[key] = (model_components, output_pixels, components)
+    return emulator_components_at_precision[key][-1]
+
+def output_layer(hidden, w_array_2, b_array_2, derivative=None):
+    """
+    Last layer of the emulator, hidden @ w_array_2.T + b_array_2, for the full weights or for lists of row blocks (see emulator_components).
+    With derivative (N, n_hidden, 5), also returns w_array_2 @ derivative.
+    """
+    if not isinstance(w_array_2, list):
+        if derivative is None:
+            return hidden @ w_array_2.T + b_array_2
+        return hidden @ w_array_2.T + b_array_2, w_array_2 @ derivative
+
+    n_pixels = sum(len(block) for block in b_array_2)
+    spectra = np.empty((len(hidden), n_pixels), dtype=np.result_type(hidden, w_array_2[0]))
+    if derivative is not None:
+        jacobian = np.empty((len(hidden), n_pixels, derivative.shape[-1]), dtype=np.result_type(derivative, w_array_2[0]))
+
+    position = 0
+    for w_block, b_block in zip(w_array_2, b_array_2):
+        spectra[:, position:position + len(b_block)] = hidden @ w_block.T + b_block
+        if derivative is not None:
+            jacobian[:, position:position + len(b_block)] = w_block @ derivative
+        position += len(b_block)
+
+    if derivative is None:
+        return spectra
+    return spectra, jacobian
+
 def get_spectrum_from_neural_net(scaled_labels, NN_coeffs):
+    return get_spectra_from_neural_net(np.atleast_2d(scaled_labels), NN_coeffs)[0]
+
+def get_spectra_from_neural_net(scaled_labels, NN_coeffs):
+    """
+    Batched version of get_spectrum_from_neural_net.
+    scaled_labels: (N, 5) array with one row of scaled labels per star
+    Returns an (N, n_pixels) array of fluxes. Each layer is one matrix-matrix product rather than N matrix-vector products.
+    """
     w_array_0, w_array_1, w_array_2, b_array_0, b_array_1, b_array_2, x_min, x_max = NN_coeffs
-    inside = np.einsum('ij,j->i', w_array_0, scaled_labels) + b_array_0
-    outside = np.einsum('ij,j->i', w_array_1, leaky_relu(inside)) + b_array_1
-    spectrum = np.einsum('ij,j->i', w_array_2, leaky_relu(outside)) + b_array_2
-    return spectrum
+    inside = scaled_labels @ w_array_0.T + b_array_0
+    outside = leaky_relu(inside) @ w_array_1.T + b_array_1
+    spectra = output_layer(leaky_relu(outside), w_array_2, b_array_2)
+    return spectra
+
+def get_spectra_and_jacobian_from_neural_net(scaled_labels, NN_coeffs):
+    """
+    As get_spectra_from_neural_net, but also returns the analytic derivative of the fluxes with respect to the scaled labels.
+    scaled_labels: (N, 5) array with one row of scaled labels per star
+    Returns an (N, n_pixels) array of fluxes and an (N, n_pixels, 5) array of d(flux)/d(scaled labels).
+    """
+    w_array_0, w_array_1, w_array_2, b_array_0, b_array_1, b_array_2, x_min, x_max = NN_coeffs
+    inside = scaled_labels @ w_array_0.T + b_array_0
+    outside = leaky_relu(inside) @ w_array_1.T + b_array_1
+
+    # Chain rule through the layers: W2 diag(leaky_relu'(outside)) W1 diag(leaky_relu'(inside)) W0
+    d_inside = leaky_relu_derivative(inside)[:, :, np.newaxis] * w_array_0
+    d_outside = leaky_relu_derivative(outside)[:, :, np.newaxis] * (w_array_1 @ d_inside)
+    spectra, jacobian = output_layer(leaky_relu(outside), w_array_2, b_array_2, derivative=d_outside)
+
+    return spectra, jacobian
 
 # %%
 def create_synthetic_spectrum(model_parameters, model_labels, default_model=None, default_model_name=None, debug=True, apply_zeropoints=False):
@@ -366,6 +904,43 @@ def create_synthetic_spectrum(model_parameters, model_labels, default_model=None
     Pass each star's individual labels and paramater values.
     """
     
+    scaled_labels = scale_labels(get_emulator_labels(model_parameters, model_labels))
+
+    model_flux = get_spectrum_from_neural_net(scaled_labels.astype(model_precision), emulator_components(pruned=False))
+
+    return(
+        model_flux
+    )
+
+def create_synthetic_spectra(component_parameters, model_labels):
+    """
+    Batched version of create_synthetic_spectrum.
+    Pass a list with one parameter dictionary per star (e.g. both binary components). All stars share the same model_labels.
+    Returns an (N, n_pixels) array of fluxes created with a single neural network call.
+    """
+    labels = np.array([get_emulator_labels(model_parameters, model_labels) for model_parameters in component_parameters])
+
+    return get_spectra_from_neural_net(scale_labels(labels).astype(model_precision), emulator_components())
+
+def create_synthetic_spectra_and_jacobian(component_parameters, model_labels):
+    """
+    As create_synthetic_spectra, but also returns d(flux)/d(teff, logg, fe_h, vmic, vsini) for each star.
+    The derivatives are with respect to the model parameters, i.e. teff in units of 1000 K.
+    Returns an (N, n_pixels) array of fluxes and an (N, n_pixels, 5) array of derivatives.
+    """
+    labels = np.array([get_emulator_labels(model_parameters, model_labels) for model_parameters in component_parameters])
+
+    spectra, jacobian = get_spectra_and_jacobian_from_neural_net(scale_labels(labels).astype(model_precision), emulator_components())
+
+    # d(scaled label)/d(model parameter). Teff is passed to the neural network in K.
+    label_scale = np.array([1000., 1., 1., 1., 1.]) / (model_components[-1] - model_components[-2])
+
+    return spectra, jacobian * label_scale
+
+def get_emulator_labels(model_parameters, model_labels):
+    """
+    Returns the neural network input labels (teff in K, logg, fe_h, vmic, vsini) of one star.
+    """
     if 'teff' in model_labels:
         teff = 1000. * model_parameters['teff']
     else:
@@ -389,18 +964,13 @@ def create_synthetic_spectrum(model_parameters, model_labels, default_model=None
     else:
         raise ValueError('You have to define vsini as input parameter')
 
-    
-    model_labels = np.array([
+    return np.array([
         teff, logg, fe_h, vmic, vsini
     ])
 
-    scaled_labels = (model_labels - model_components[-2])/(model_components[-1] - model_components[-2]) - 0.5
-
-    model_flux = get_spectrum_from_neural_net(scaled_labels, model_components)
-
-    return(
-        model_flux
-    )
+def scale_labels(labels):
+    # Scale labels (or an (N, 5) array of labels) to the range the neural network was trained on
+    return (labels - model_components[-2])/(model_components[-1] - model_components[-2]) - 0.5
 
 # %% [markdown]
 # ## 2.2) Broaden & interpolate synthetic spectra to match observational data
@@ -477,15 +1047,9 @@ def sclip(p,fit,n,ye=[],sl=99999,su=99999,min=0,max=0,min_data=1,grow=0,global_m
             bad_values=np.concatenate(((p[-1]-f).argsort()[-int(max):], (p[-1]-f).argsort()[:int(min)]))
             b[bad_values]=False
 
-        #check the grow parameter:
+        #check the grow parameter (reject int(grow) points on either side of each rejected point):
         if grow>=1 and nv==2:
-            b_grown=np.ones(dim, dtype=bool)
-            for ind,val in enumerate(b):
-                if val==False:
-                    ind_l=ind-int(grow)
-                    ind_u=ind+int(grow)+1
-                    if ind_l<0: ind_l=0
-                    b_grown[ind_l:ind_u]=False
+            b_grown=np.convolve(np.invert(b).astype(int), np.ones(2*int(grow)+1, dtype=int), mode='full')[int(grow):int(grow)+dim]==0
 
             b=b_grown
 
@@ -520,7 +1084,142 @@ def sclip(p,fit,n,ye=[],sl=99999,su=99999,min=0,max=0,min_data=1,grow=0,global_m
     return f,tmp_results,b
 
 # %%
-def calculate_default_degrading_wavelength_grid(default_model_wave, spectrum, synth_res=300000.):
+def degrading_wavelength_grid(l_start, l_end, map_fit, sampl, min_sampl, tolerance=1e-4, max_iterations=10):
+    """
+    Creates the non-uniform wavelength grid l_0 = l_start, l_(i+1) = l_i + map_fit(l_i)/sampl/min_sampl, up to and including the first point >= l_end.
+
+    Instead of adding one sample at a time, the grid is created vectorised:
+    the sample index as a function of wavelength follows from integrating dl/di = step(l) (with the leading correction for discrete steps),
+    and this first guess is refined with Newton iterations of the recurrence.
+
+    Rounding errors that accumulate over the several 100000 samples of a CCD limit the agreement with the sample-by-sample loop to ~1e-5 of a step.
+
+    INPUT:
+    map_fit: np.poly1d of the kernel sigma as a function of wavelength
+    tolerance: maximum change of any sample in the last Newton iteration, in units of the local step. None runs the original (slow) loop.
+
+    OUTPUT:
+    array of wavelengths
+    """
+    if tolerance is None:
+        l_new=[l_start]
+        while l_new[-1]<l_end:
+            # THIS IS THE BOTTLENECK OF THE COMPUTATION
+            l_new.append(l_new[-1]+map_fit(l_new[-1])/sampl/min_sampl)
+        return np.array(l_new)
+
+    step = lambda l: map_fit(l)/sampl/min_sampl
+    step_derivative = lambda l: map_fit.deriv()(l)/sampl/min_sampl
+
+    # Sample index i(l) = integral of dl/g(l), where g = step * (1 - step'/2) is the continuous equivalent of the discrete steps.
+    # The range extends a few steps beyond l_end, so that the first guess covers the whole grid.
+    l_fine = np.linspace(l_start, l_end + 10*step(l_end), 10000)
+    inverse_g = 1. / (step(l_fine) * (1 - 0.5*step_derivative(l_fine)))
+    index_fine = np.concatenate(([0.], np.cumsum(0.5 * (inverse_g[1:] + inverse_g[:-1]) * np.diff(l_fine))))
+
+    l_new = np.interp(np.arange(int(np.ceil(np.interp(l_end, l_fine, index_fine))) + 5), index_fine, l_fine)
+
+    # Newton iterations: propagate the defects of the recurrence, e_(i+1) = (1 + step'(l_i)) e_i - defect_i
+    for iteration in range(max_iterations):
+        defect = l_new[1:] - l_new[:-1] - step(l_new[:-1])
+        growth = np.cumprod(1 + step_derivative(l_new[:-1]))
+        correction = np.concatenate(([0.], growth * np.cumsum(-defect / growth)))
+        l_new = l_new + correction
+        if np.max(np.abs(correction) / step(l_new)) < tolerance:
+            break
+    else:
+        logging.warning('Degrading wavelength grid did not converge to the requested tolerance.')
+
+    # If the first guess fell short of l_end, the remaining samples are added one at a time
+    if l_new[-1] < l_end:
+        l_new = list(l_new)
+        while l_new[-1] < l_end:
+            if not step(l_new[-1]) > 0:
+                raise ValueError('Degrading wavelength grid has a non-positive step at ' + str(l_new[-1]) + ', it cannot reach ' + str(l_end))
+            l_new.append(l_new[-1] + step(l_new[-1]))
+        return np.array(l_new)
+
+    return l_new[:np.argmax(l_new >= l_end) + 1]
+
+def degradation_grid_cache_key(synth, spectrum, ccd, synth_res, grid_tolerance, lsf_decimals=None):
+    """
+    Fingerprint of everything the degradation wavelength grid of a CCD depends on:
+    the emulator wavelengths of the CCD, the CCD wavelength solution (crval, cdelt, number of pixels), the LSF, synth_res and grid_tolerance.
+    With lsf_decimals, the LSF is rounded first, so that nearly identical LSFs (e.g. same plate and fibre) share a grid.
+    """
+    lsf = np.asarray(spectrum['lsf_ccd'+str(ccd)], dtype=np.float64)
+    if lsf_decimals is not None:
+        lsf = np.round(lsf, lsf_decimals)
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update(b'degradation_grid_v1')
+    fingerprint.update(np.asarray(synth, dtype=np.float64).tobytes())
+    fingerprint.update(np.array([spectrum['crval_ccd'+str(ccd)], spectrum['cdelt_ccd'+str(ccd)], len(spectrum['counts_ccd'+str(ccd)]), synth_res], dtype=np.float64).tobytes())
+    fingerprint.update(lsf.tobytes())
+    fingerprint.update(repr(grid_tolerance).encode())
+    return fingerprint.hexdigest()
+
+def load_cached_degradation_grid(key):
+    """
+    Returns the cached degradation wavelength grid for this key, or None. Counts hits and misses in degradation_grid_cache_stats.
+    """
+    path = os.path.join(degradation_grid_cache_directory, key + '.npz')
+    try:
+        with np.load(path) as cached:
+            l_new = cached['initial_l']
+        # Mark as recently used for the eviction
+        os.utime(path)
+    except (OSError, ValueError, KeyError):
+        degradation_grid_cache_stats['misses'] += 1
+        return None
+
+    degradation_grid_cache_stats['hits'] += 1
+    return l_new
+
+def save_degradation_grid(key, l_new):
+    """
+    Stores a degradation wavelength grid in the cache and evicts the least recently used grids if the cache is too large.
+    """
+    Path(degradation_grid_cache_directory).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(degradation_grid_cache_directory, key + '.npz')
+
+    with atomic_write_file(path) as f:
+        np.savez(f, initial_l=l_new)
+
+    evict_degradation_grid_cache()
+
+def evict_degradation_grid_cache(max_bytes=None):
+    """
+    Removes the least recently used grids until the cache is smaller than max_bytes (default: degradation_grid_cache_max_bytes).
+    """
+    if max_bytes is None:
+        max_bytes = degradation_grid_cache_max_bytes
+
+    cached_files = []
+    for file_name in os.listdir(degradation_grid_cache_directory):
+        if file_name.endswith('.npz'):
+            try:
+                file_stat = os.stat(os.path.join(degradation_grid_cache_directory, file_name))
+            except FileNotFoundError:
+                # Removed by another process in the meantime
+                continue
+            cached_files.append((file_stat.st_mtime, file_stat.st_size, file_name))
+
+    total_bytes = sum(size for _, size, _ in cached_files)
+    for _, size, file_name in sorted(cached_files):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(degradation_grid_cache_directory, file_name))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+def calculate_default_degrading_wavelength_grid(default_model_wave, spectrum, synth_res=300000., grid_tolerance=1e-4, lsf_decimals=None):
+    """
+    Creates the wavelength grid onto which the emulator spectrum of each available CCD is interpolated before the convolution.
+    Grids are cached on disk in degradation_grid_cache_directory (see degradation_grid_cache_key), so objects with the same LSF skip the construction.
+    """
     initial_l = dict()
     
     for ccd in spectrum['available_ccds']:
@@ -551,6 +1250,13 @@ def calculate_default_degrading_wavelength_grid(default_model_wave, spectrum, sy
         if not (synth[1]-synth[0])==(synth[-1]-synth[-2]):
             logging.error('Synthetic spectrum must have linear (equidistant) sampling.')		
 
+        if degradation_grid_cache_directory is not None:
+            cache_key = degradation_grid_cache_key(synth, spectrum, ccd, synth_res, grid_tolerance, lsf_decimals)
+            cached_l = load_cached_degradation_grid(cache_key)
+            if cached_l is not None:
+                initial_l['ccd'+str(ccd)] = cached_l
+                continue
+
         #current sampling:
         sampl=synth[1]-synth[0]
         galah_sampl=spectrum['cdelt_ccd'+str(ccd)]
@@ -567,49 +1273,68 @@ def calculate_default_degrading_wavelength_grid(default_model_wave, spectrum, sy
         #fit it with the polynomial, so we have a function instead of sampled values:
         map_fit=np.poly1d(np.polyfit(synth, s, deg=6))
 
-        #create an array with new sampling. The first point is the same as in the spectrum:
-        l_new=[synth[0]]
-
         #oversampling. If synthetic spectrum sampling is much finer than the size of the kernel, the code would work, but would return badly sampled spectrum. this is because from here on the needed sampling is measured in units of sigma.
         oversample=galah_sampl/sampl*10.0
 
         #minimal needed sampling
         min_sampl=max(s_original)/sampl/sampl*oversample
         
-        #keep adding samples until end of the wavelength range is reached
-        while l_new[-1]<synth[-1]+sampl:
-            # THIS IS THE BOTTLENECK OF THE COMPUTATION
-            l_new.append(l_new[-1]+map_fit(l_new[-1])/sampl/min_sampl)
+        #create an array with new sampling. The first point is the same as in the spectrum. Keep adding samples until end of the wavelength range is reached
+        initial_l['ccd'+str(ccd)] = degrading_wavelength_grid(synth[0], synth[-1]+sampl, map_fit, sampl, min_sampl, tolerance=grid_tolerance)
 
-        initial_l['ccd'+str(ccd)] = np.array(l_new)
+        if degradation_grid_cache_directory is not None:
+            save_degradation_grid(cache_key, initial_l['ccd'+str(ccd)])
     return(initial_l)
 
 
 
 # %%
 def galah_kern(fwhm, b):
-    """ Returns a normalized 1D kernel as is used for GALAH resolution profile """
-    size=2*(fwhm/2.355)**2
+    """ Returns a normalized 1D kernel as is used for GALAH resolution profile. The array is cached (see galah_kern_table) and read-only. """
+    return galah_kern_table(round(float(fwhm), galah_kern_decimals), float(b))
 
-    # # # Check if 'size' is masked
-    # if np.ma.is_masked(size):
-    #     size = np.ma.filled(size, fill_value=0)  # or some other default value
-    #     # Replace nans with 0
-    #     size = np.nan_to_num(size)
+@functools.lru_cache(maxsize=64)
+def galah_kern_table(fwhm, b):
+    size=2*(fwhm/2.355)**2
 
     size_grid = int(size) # we limit the size of kernel, so it is as small as possible (or minimal size) for faster calculations
     if size_grid<7: size_grid=7
-    x= scipy.mgrid[-size_grid:size_grid+1]
+    x= np.arange(-size_grid, size_grid+1)
     g = np.exp(-0.693147*np.power(abs(2*x/fwhm), b))
-    return g / np.sum(g)
+    g /= np.sum(g)
+
+    g.flags.writeable = False
+    return g
+
+@functools.lru_cache(maxsize=64)
+def galah_kern_fft_table(fwhm, b, n_fft, precision='float64'):
+    kernel_fft = scipy.fft.rfft(galah_kern_table(fwhm, b).astype(precision), n_fft)
+    kernel_fft.flags.writeable = False
+    return kernel_fft
+
+def galah_kern_fft(fwhm, b, n_fft, precision=np.float64):
+    """ Real FFT of galah_kern(fwhm, b), zero-padded to n_fft points. Cached, so each CCD of a spectrum transforms its kernel once. """
+    return galah_kern_fft_table(round(float(fwhm), galah_kern_decimals), float(b), int(n_fft), np.dtype(precision).name)
+
+def convolve_galah_kern(flux, fwhm, b):
+    """
+    Convolves flux with galah_kern(fwhm, b), as scipy.signal.fftconvolve(flux, galah_kern(fwhm, b), mode='same'), but with the transform of the kernel taken from galah_kern_fft.
+    The convolution is done in model_precision.
+    """
+    kernel_size = len(galah_kern(fwhm, b))
+    n_fft = scipy.fft.next_fast_len(len(flux) + kernel_size - 1, real=True)
+    con_f = scipy.fft.irfft(scipy.fft.rfft(np.asarray(flux, dtype=model_precision), n_fft) * galah_kern_fft(fwhm, b, n_fft, model_precision), n_fft)
+    offset = (kernel_size - 1) // 2
+    return con_f[offset:offset + len(flux)]
 
 # %%
-def synth_resolution_degradation(l, res_map, res_b, synth, initial_l, synth_res=300000.0, reuse_initial_res_wave_grid=True):
+def synth_resolution_degradation(l, res_map, res_b, synth, initial_l, synth_res=300000.0, reuse_initial_res_wave_grid=True, grid_tolerance=1e-4):
     """
     Take a synthetic spectrum with a very high  resolution and degrade its resolution to the resolution profile of the observed spectrum. The synthetic spectrum should not be undersampled, or the result of the convolution might be wrong.
     Parameters:
         synth np array or similar: an array representing the synthetic spectrum. Must have size m x 2. First column is the wavelength array, second column is the flux array. Resolution of the synthetic spectrum must be constant and higher than that of the observed spectrum.
         synth_res (float): resolving power of the synthetic spectrum
+        grid_tolerance (float): tolerance of the new wavelength grid if it is not reused (see degrading_wavelength_grid)
     Returns:
         Convolved syntehtic spectrum as a np array of size m x 2.
     """
@@ -648,42 +1373,288 @@ def synth_resolution_degradation(l, res_map, res_b, synth, initial_l, synth_res=
         #fit it with the polynomial, so we have a function instead of sampled values:
         map_fit=np.poly1d(np.polyfit(synth[:,0], s, deg=6))
 
-        #create an array with new sampling. The first point is the same as in the spectrum:
-        l_new=[synth[:,0][0]]
-
         #minimal needed sampling
         min_sampl=max(s_original)/sampl/sampl*oversample
 
-        #keep adding samples until end of the wavelength range is reached
-        while l_new[-1]<synth[:,0][-1]+sampl:
-            # THIS IS THE BOTTLENECK OF THE COMPUTATION
-            l_new.append(l_new[-1]+map_fit(l_new[-1])/sampl/min_sampl)
-        
-        l_new = np.array(l_new)
+        #create an array with new sampling. The first point is the same as in the spectrum. Keep adding samples until end of the wavelength range is reached
+        l_new = degrading_wavelength_grid(synth[:,0][0], synth[:,0][-1]+sampl, map_fit, sampl, min_sampl, tolerance=grid_tolerance)
     else:
         l_new = initial_l
         
     #interpolate the spectrum to the new sampling:
     new_f=np.interp(l_new,synth[:,0],synth[:,1])
 
-    kernel_=galah_kern(max(s_original)/sampl*oversample, res_b)
-
-    con_f=signal.fftconvolve(new_f,kernel_,mode='same')
+    con_f=convolve_galah_kern(new_f, max(s_original)/sampl*oversample, res_b)
 
     return np.array([np.array(l_new),con_f])
 
 # %%
+def build_degradation_operators(default_model_wave, spectrum, initial_l, synth_res=300000., rv_margin=None):
+    """
+    Precomputes synth_resolution_degradation (with reuse_initial_res_wave_grid=True) as a linear operator for each available CCD:
+    a sparse matrix for the linear interpolation from the emulator pixels onto initial_l, and the Fourier transform of the GALAH kernel for the convolution.
+    The kernel width is evaluated for the unshifted CCD sampling, i.e. its weak dependence on rv (|rv|/c < 1e-3) is neglected.
+
+    With rv_margin (in km/s), initial_l and the emulator pixels are restricted to the observed wavelengths shifted by up to +-rv_margin,
+    plus the resampling stencil and half the kernel on either side, so the broadened flux inside that window is unchanged. Radial velocities beyond the margin raise a ValueError (see check_rv_margin).
+    """
+    degradation_operators = dict()
+
+    for ccd in spectrum['available_ccds']:
+
+        # The emulator grid is sorted, so the pixels of the CCD are one contiguous slice
+        pixels_model_ccd = np.where((default_model_wave > (3+ccd)*1000) & (default_model_wave < (4+ccd)*1000))[0]
+        model_pixels = slice(pixels_model_ccd[0], pixels_model_ccd[-1] + 1)
+        synth = default_model_wave[model_pixels]
+        l_new = initial_l['ccd'+str(ccd)]
+
+        # Same kernel as in synth_resolution_degradation (always for the whole CCD)
+        sampl = synth[1] - synth[0]
+        oversample = spectrum['cdelt_ccd'+str(ccd)]/sampl*10.0
+        fwhm = max(synth/synth_res)/sampl*oversample
+        kernel_ = galah_kern(fwhm, spectrum['lsf_b_ccd'+str(ccd)])
+        offset = (len(kernel_) - 1) // 2
+
+        if rv_margin is not None:
+            # Resampled points lie within wave * (1 -+ rv_margin/c). Each needs a stencil of up to 8 grid points and the convolution half a kernel beyond that.
+            wave = spectrum['wave_ccd'+str(ccd)]
+            padding = 8 + len(kernel_)
+            first = max(np.searchsorted(l_new, wave[0] * (1 - rv_margin / 299792.458)) - padding, 0)
+            last = min(np.searchsorted(l_new, wave[-1] * (1 + rv_margin / 299792.458)) + padding, len(l_new))
+            l_new = l_new[first:last]
+
+            first_model_pixel = max(np.searchsorted(synth, l_new[0], side='right') - 1, 0)
+            last_model_pixel = min(np.searchsorted(synth, l_new[-1]) + 1, len(synth))
+            model_pixels = slice(model_pixels.start + first_model_pixel, model_pixels.start + last_model_pixel)
+            synth = default_model_wave[model_pixels]
+
+        # Linear interpolation (as np.interp, constant beyond the edges) with two entries per row
+        left = np.clip(np.searchsorted(synth, l_new, side='right') - 1, 0, len(synth) - 2)
+        weight = np.clip((l_new - synth[left]) / (synth[left+1] - synth[left]), 0, 1)
+        interpolation = scipy.sparse.csr_matrix(
+            (
+                np.concatenate((1 - weight, weight)),
+                (np.tile(np.arange(len(l_new)), 2), np.concatenate((left, left+1)))
+            ),
+            shape=(len(l_new), len(synth))
+        )
+
+        n_fft = scipy.fft.next_fast_len(len(l_new) + len(kernel_) - 1, real=True)
+
+        degradation_operators['ccd'+str(ccd)] = {
+            'model_pixels': model_pixels,
+            # Same as model_pixels, but for the pruned emulator output (see prune_emulator_output)
+            'output_pixels': model_pixels,
+            'wave': l_new,
+            'interpolation': interpolation,
+            # The same interpolation as index and weight arrays, for the compiled backend
+            'interpolation_left': left,
+            'interpolation_weight': weight,
+            'kernel_fft': galah_kern_fft(fwhm, spectrum['lsf_b_ccd'+str(ccd)], n_fft),
+            'n_fft': n_fft,
+            'fwhm': fwhm,
+            'lsf_b': spectrum['lsf_b_ccd'+str(ccd)],
+            # Start of the central part of the full convolution (fftconvolve mode='same')
+            'offset': offset,
+            'size': len(l_new),
+            'rv_margin': rv_margin
+        }
+
+    return(degradation_operators)
+
+def check_rv_margin(degradation_operator, rvs):
+    """ Raises a ValueError if a radial velocity lies outside the margin the (pruned) degradation operator covers, where the resampling would extrapolate. """
+    if degradation_operator['rv_margin'] is not None and np.any(np.abs(rvs) > degradation_operator['rv_margin']):
+        raise ValueError('Radial velocities ' + str(list(np.asarray(rvs, dtype=float))) + ' km/s are outside the +-' + str(degradation_operator['rv_margin'])
+                         + ' km/s covered by the pruned degradation operators. Increase the rv_margin of load_neural_network or pruning_rv_margin.')
+
+def prune_emulator_output(degradation_operators):
+    """
+    Returns the emulator pixels used by the degradation operators as a list of slices, in order, and points each operator's output_pixels at its part of the pruned output.
+    With emulator_output_pixels set to these, the last layer of the emulator only computes the rows needed (see emulator_components).
+    """
+    operators = sorted(degradation_operators.values(), key=lambda operator: operator['model_pixels'].start)
+
+    output_pixels = []
+    position = 0
+    for operator in operators:
+        output_pixels.append(operator['model_pixels'])
+        size = operator['model_pixels'].stop - operator['model_pixels'].start
+        operator['output_pixels'] = slice(position, position + size)
+        position += size
+
+    return output_pixels
+
+def operator_pixels(degradation_operator, model_fluxes):
+    """ Slice of the CCD in model_fluxes, which is either on the whole emulator grid or the pruned emulator output (see prune_emulator_output). """
+    if model_fluxes.shape[-1] == len(default_model_wave):
+        return degradation_operator['model_pixels']
+    return degradation_operator['output_pixels']
+
+def apply_degradation_operator(degradation_operator, model_fluxes):
+    """
+    Broadens a (K, n_pixels) stack of emulator spectra with a precomputed operator from build_degradation_operators.
+    All spectra are interpolated in one sparse product and convolved in one FFT.
+    Returns a (K, n_degraded_pixels) array on the initial_l grid of the CCD.
+    """
+    new_f = at_model_precision(degradation_operator, 'interpolation') @ np.transpose(model_fluxes[:, operator_pixels(degradation_operator, model_fluxes)]).astype(model_precision, copy=False)
+    con_f = scipy.fft.irfft(
+        scipy.fft.rfft(new_f, degradation_operator['n_fft'], axis=0) * at_model_precision(degradation_operator, 'kernel_fft')[:, np.newaxis],
+        degradation_operator['n_fft'],
+        axis=0
+    )
+    return con_f[degradation_operator['offset']:degradation_operator['offset'] + degradation_operator['size']].T
+
+def build_batched_convolution(degradation_operators, ccds):
+    """
+    Layout for broadening the CCDs in one FFT (see apply_batched_degradation). Each CCD becomes one row of a zero-padded 2-D array per spectrum.
+    The rows are padded to a common length of at least size + kernel size - 1 of every CCD, so the circular convolution never wraps one end of a row onto the other.
+    """
+    operators = [degradation_operators['ccd'+str(ccd)] for ccd in ccds]
+    n_fft = scipy.fft.next_fast_len(max(operator['size'] + 2 * operator['offset'] for operator in operators), real=True)
+
+    return {
+        'ccds': list(ccds),
+        'n_fft': n_fft,
+        # (n_ccds, 1, n_frequencies), broadcast over the spectra
+        'kernel_fft': np.array([galah_kern_fft(operator['fwhm'], operator['lsf_b'], n_fft) for operator in operators])[:, np.newaxis],
+        'width': max(operator['size'] for operator in operators)
+    }
+
+def apply_batched_degradation(model_fluxes):
+    """
+    apply_degradation_operator for all CCDs of batched_convolution_layout at once: the (K, n_pixels) spectra are interpolated per CCD into a (n_ccds, K, n_fft) array,
+    which is convolved with one forward and one inverse FFT along the last axis.
+    Returns a dictionary keyed by 'ccd'+str(ccd) with (K, n_degraded_pixels) arrays.
+    """
+    packed = np.zeros((len(batched_convolution_layout['ccds']), len(model_fluxes), batched_convolution_layout['width']), dtype=model_precision)
+    for row, ccd in enumerate(batched_convolution_layout['ccds']):
+        degradation_operator = degradation_operators['ccd'+str(ccd)]
+        packed[row, :, :degradation_operator['size']] = (at_model_precision(degradation_operator, 'interpolation') @ np.transpose(model_fluxes[:, operator_pixels(degradation_operator, model_fluxes)]).astype(model_precision, copy=False)).T
+
+    con_f = scipy.fft.irfft(
+        scipy.fft.rfft(packed, batched_convolution_layout['n_fft'], axis=-1, workers=convolution_workers) * at_model_precision(batched_convolution_layout, 'kernel_fft'),
+        batched_convolution_layout['n_fft'],
+        axis=-1,
+        workers=convolution_workers
+    )
+
+    models_lsf = dict()
+    for row, ccd in enumerate(batched_convolution_layout['ccds']):
+        degradation_operator = degradation_operators['ccd'+str(ccd)]
+        models_lsf['ccd'+str(ccd)] = con_f[row, :, degradation_operator['offset']:degradation_operator['offset'] + degradation_operator['size']]
+    return models_lsf
+
+# %%
+def renormalisation_continuum(spectrum, ccd):
+    """
+    Continuum by which the observed counts of a CCD are divided, i.e. sclip((wave, counts / model flux), chebyshev, 3, ye=counts_unc, su=5, sl=5, min_data=100).
+    See renormalisation_mode.
+    """
+    wave = spectrum['wave_ccd'+str(ccd)]
+    ratio = spectrum['counts_ccd'+str(ccd)] / spectrum['flux_model_ccd'+str(ccd)]
+
+    # The final clip mask is kept for renormalised_flux_jacobian
+    if renormalisation_mode is None:
+        continuum, _, spectrum['renormalisation_mask_ccd'+str(ccd)] = sclip((wave, ratio), chebyshev, int(3), ye=spectrum['counts_unc_ccd'+str(ccd)], su=5, sl=5, min_data=100, verbose=False)
+        return continuum
+
+    state = renormalisation_state(spectrum, ccd)
+    continuum, spectrum['renormalisation_mask_ccd'+str(ccd)] = sclip_chebyshev(state, ratio, spectrum['counts_unc_ccd'+str(ccd)], int(3), sl=5, su=5, min_data=100, warm_start=renormalisation_mode == 'warm')
+    return continuum
+
+def renormalisation_state(spectrum, ccd):
+    # Vandermonde matrix and cached fits of chebyshev_fit for the wavelengths of a CCD
+    wave = spectrum['wave_ccd'+str(ccd)]
+    state = renormalisation_states.get('ccd'+str(ccd))
+    if state is None or not np.array_equal(state['wave'], wave):
+        state = {'wave': wave, 'vander': np.polynomial.chebyshev.chebvander(wave, 4), 'fits': dict(), 'mask': None}
+        renormalisation_states['ccd'+str(ccd)] = state
+    return state
+
+def renormalised_flux_jacobian(spectrum, ccd, flux_model_jacobian):
+    """
+    Jacobian of the renormalised observed flux of a CCD (flux_obs_ccd = counts / continuum) from that of its model flux (flux_model_ccd).
+    With the clip mask of the last renormalisation held fixed, the continuum is linear in counts / model flux, continuum = V P_mask (counts / model flux),
+    where P_mask is the least-squares solution cached by chebyshev_fit. Call after the renormalisation at the same parameters.
+    """
+    counts = spectrum['counts_ccd'+str(ccd)][:, np.newaxis]
+    ratio_jacobian = -counts / spectrum['flux_model_ccd'+str(ccd)][:, np.newaxis]**2 * flux_model_jacobian
+    continuum_jacobian = chebyshev_fit(renormalisation_state(spectrum, ccd), ratio_jacobian, spectrum['renormalisation_mask_ccd'+str(ccd)])
+
+    continuum = counts / spectrum['flux_obs_ccd'+str(ccd)][:, np.newaxis]
+    return -counts / continuum**2 * continuum_jacobian
+
+def chebyshev_fit(state, y, mask, max_cached_fits=8):
+    """
+    chebyshev(), with the Vandermonde matrix of the (fixed) wavelengths precomputed and the least-squares solution for each mask cached.
+    Solves the same column-scaled least-squares problem with the same cutoff for small singular values as np.polynomial.chebyshev.chebfit.
+    """
+    key = np.packbits(mask).tobytes()
+    solution = state['fits'].get(key)
+
+    if solution is None:
+        lhs = state['vander'][mask].T
+        scale = np.sqrt(np.square(lhs).sum(1))
+        scale[scale == 0] = 1
+        solution = np.linalg.pinv((lhs.T / scale), rcond=lhs.shape[1]*np.finfo(float).eps) / scale[:, np.newaxis]
+
+        if len(state['fits']) >= max_cached_fits:
+            del state['fits'][next(iter(state['fits']))]
+        state['fits'][key] = solution
+
+    return state['vander'] @ (solution @ y[mask])
+
+def sclip_chebyshev(state, y, ye, n, sl=99999, su=99999, min_data=1, warm_start=False):
+    """
+    sclip(p, chebyshev, n, ye=ye, sl=sl, su=su, min_data=min_data) for a fixed wavelength grid, using the cached fits of chebyshev_fit.
+    With warm_start, the first fit uses the final clip mask of the previous call rather than all points.
+    Optimiser steps change the model only slightly, so the mask usually stays the same and no new factorisation is needed.
+    Returns the final fit and the final mask.
+    """
+    dim = len(y)
+    if sl>=99999 and su!=sl: sl=su
+    if su>=99999 and sl!=su: su=sl
+
+    b_old = np.ones(dim, dtype=bool)
+    if warm_start and state['mask'] is not None and len(state['mask']) == dim:
+        b_old = state['mask']
+
+    f = chebyshev_fit(state, y, b_old)
+    s = np.std(y[b_old]-f[b_old])
+
+    for step in range(n):
+        b = ((f-y)<(sl*(s+ye))) & ((f-y)>-(su*(s+ye)))
+
+        #check that the minimal number of good points is not too low:
+        if np.count_nonzero(b)<min_data:
+            b=b_old
+            break
+
+        #check if the new b is the same as old one and break if yes:
+        if np.array_equal(b,b_old):
+            break
+
+        #fit again
+        f=chebyshev_fit(state, y, b)
+        s=np.std(y[b]-f[b])
+        b_old=b
+
+    state['mask'] = b
+    return f, b
+
 def chebyshev(p,ye,mask):
     coef=np.polynomial.chebyshev.chebfit(p[0][mask], p[1][mask], 4)
     cont=np.polynomial.chebyshev.chebval(p[0],coef)
     return cont
 
 # %%
-def cubic_spline_interpolate(old_wavelength, old_flux, new_wavelength):
+def cubic_spline_interpolate(old_wavelength, old_flux, new_wavelength, return_derivative=False):
     """
     INPUT:
     old_wavelength, old_flux: Input spectrum that has to be interpolated
     new_wavelength: Wavelength array onto which we want to interpolate
+    return_derivative: also return d(flux)/d(wavelength) of the spline at new_wavelength
     
     OUTPUT:
     flux interpolated on new_wavelength array
@@ -691,7 +1662,10 @@ def cubic_spline_interpolate(old_wavelength, old_flux, new_wavelength):
     # print("old_wavelength", old_wavelength)
     # print("old_flux", old_flux)
     # print("new_wavelength", new_wavelength)
-    return scipy.interpolate.CubicSpline(old_wavelength, old_flux)(new_wavelength)
+    spline = scipy.interpolate.CubicSpline(old_wavelength, old_flux)
+    if return_derivative:
+        return spline(new_wavelength), spline(new_wavelength, 1)
+    return spline(new_wavelength)
 
 # %%
 def rv_shift(rv_value, wavelength):
@@ -761,59 +1735,13 @@ def create_synthetic_binary_spectrum_at_observed_wavelength(model, spectrum, sam
         component_2_model_parameter = np.insert(component_2_model_parameter, 3, model_parameters[model_labels=='fe_h'][0])
 
 
-    # This returns synthetic spectra for each component created by the neural network
+    # This returns synthetic spectra for each component created by the neural network (one batched call for both stars)
     # print(model.id ,component_1_model_parameter)
-    component_1_model = create_synthetic_spectrum(component_1_model_parameter, component_1_labels)
-    component_2_model = create_synthetic_spectrum(component_2_model_parameter, component_2_labels)
-    
-    for ccd in spectrum['available_ccds']:
-        
-        wave_model_ccd = (default_model_wave > (3+ccd)*1000) & (default_model_wave < (4+ccd)*1000)
-    
-        # print("model wave", default_model_wave)
-        # print("synth", default_model_wave[wave_model_ccd])
-        # print("synth 2", component_1_model[wave_model_ccd])
-                                           
+    component_models = create_synthetic_spectra([component_1_model_parameter, component_2_model_parameter], component_1_labels)
 
-        wave_model_1_ccd_lsf, component_1_model_ccd_lsf = synth_resolution_degradation(
-                l = rv_shift(rv_1, spectrum['wave_ccd'+str(ccd)]), 
-                res_map = spectrum['lsf_ccd'+str(ccd)], 
-                res_b = spectrum['lsf_b_ccd'+str(ccd)], 
-                synth = np.array([default_model_wave[wave_model_ccd], component_1_model[wave_model_ccd]]).T,
-                initial_l=initial_l['ccd'+str(ccd)],
-                synth_res=300000.0,
-                reuse_initial_res_wave_grid = True
-            )
-        
-    
-        wave_model_2_ccd_lsf, component_2_model_ccd_lsf = synth_resolution_degradation(
-                l = rv_shift(rv_2,spectrum['wave_ccd'+str(ccd)]), 
-                res_map = spectrum['lsf_ccd'+str(ccd)], 
-                res_b = spectrum['lsf_b_ccd'+str(ccd)], 
-                synth = np.array([default_model_wave[wave_model_ccd], component_2_model[wave_model_ccd]]).T,
-                initial_l=initial_l['ccd'+str(ccd)],
-                synth_res=300000.0,
-                reuse_initial_res_wave_grid = True
-            )
-        
-        component_1_model_ccd_lsf_at_observed_wavelength = cubic_spline_interpolate(
-            rv_shift(-rv_1,wave_model_1_ccd_lsf),
-            component_1_model_ccd_lsf,
-            spectrum['wave_ccd'+str(ccd)]
-        )
-        component_2_model_ccd_lsf_at_observed_wavelength = cubic_spline_interpolate(
-            rv_shift(-rv_2,wave_model_2_ccd_lsf),
-            component_2_model_ccd_lsf,
-            spectrum['wave_ccd'+str(ccd)]
-        )
-        
-        # Combine the component models via weighting parameter q to get a model flux
-        spectrum['flux_model_ccd'+str(ccd)] = f_contr * component_1_model_ccd_lsf_at_observed_wavelength + (1-f_contr) * component_2_model_ccd_lsf_at_observed_wavelength
-
-        renormalisation_fit = sclip((spectrum['wave_ccd'+str(ccd)], spectrum['counts_ccd'+str(ccd)] / spectrum['flux_model_ccd'+str(ccd)]), chebyshev,int(3), ye=spectrum['counts_unc_ccd'+str(ccd)], su=5, sl=5, min_data=100, verbose=False)
-        spectrum['flux_obs_ccd'+str(ccd)] = spectrum['counts_ccd'+str(ccd)] / renormalisation_fit[0]
-        spectrum['flux_obs_unc_ccd'+str(ccd)] = spectrum['counts_unc_ccd'+str(ccd)] / renormalisation_fit[0]
-        
+    # Combine the component models via weighting parameter q to get a model flux
+    model_flux = combine_component_fluxes(spectrum, component_models, [rv_1, rv_2], f_contr)
+    renormalise_observed_flux(spectrum, model_flux)
 
     # Join spectra produced by the CCDs.
     wave = np.concatenate([spectrum['wave_ccd'+str(ccd)] for ccd in spectrum['available_ccds']])
@@ -851,6 +1779,347 @@ def create_synthetic_binary_spectrum_at_observed_wavelength(model, spectrum, sam
         wave, data, sigma2, data_model, model
     )
 
+def renormalise_observed_flux(spectrum, model_flux):
+    """
+    Stores the model flux (a dictionary keyed by 'ccd'+str(ccd)) in the spectrum and renormalises the observed flux and its uncertainty with it (see renormalisation_continuum).
+    """
+    for ccd in spectrum['available_ccds']:
+
+        # A copy, as the compiled backend overwrites its output buffers on the next evaluation, while the renormalisation (and renormalised_flux_jacobian) read this one
+        spectrum['flux_model_ccd'+str(ccd)] = np.array(model_flux['ccd'+str(ccd)])
+
+        renormalisation_fit = renormalisation_continuum(spectrum, ccd)
+        spectrum['flux_obs_ccd'+str(ccd)] = spectrum['counts_ccd'+str(ccd)] / renormalisation_fit
+        spectrum['flux_obs_unc_ccd'+str(ccd)] = spectrum['counts_unc_ccd'+str(ccd)] / renormalisation_fit
+
+def degrade_to_observed_wavelength(spectrum, ccd, model_fluxes, rvs, rv_derivative=False):
+    """
+    Broadens emulator spectra to the line-spread-function of one CCD and interpolates them onto its observed wavelengths.
+
+    INPUT:
+    model_fluxes: (K, n_pixels) array of emulator spectra on default_model_wave
+    rvs: K radial velocities in km/s, one per spectrum
+    rv_derivative: also return d(flux)/d(rv). The weak dependence of the kernel width on rv (through the sampling of the shifted wavelengths) is neglected.
+
+    OUTPUT:
+    (K, n_observed_pixels) array of fluxes at spectrum['wave_ccd'+str(ccd)] (and the same shape for d(flux)/d(rv))
+    """
+    # With a precomputed operator, all spectra are broadened and resampled together
+    if 'ccd'+str(ccd) in degradation_operators:
+        return degrade_to_observed_wavelength_fused(spectrum, ccd, model_fluxes, rvs, rv_derivative)
+
+    wave_model_ccd = (default_model_wave > (3+ccd)*1000) & (default_model_wave < (4+ccd)*1000)
+
+    fluxes = np.empty((len(rvs), len(spectrum['wave_ccd'+str(ccd)])))
+    flux_rv_derivatives = np.empty_like(fluxes)
+    for index, (model_flux, rv) in enumerate(zip(model_fluxes, rvs)):
+        wave_model_ccd_lsf, model_ccd_lsf = synth_resolution_degradation(
+                l = rv_shift(rv, spectrum['wave_ccd'+str(ccd)]), 
+                res_map = spectrum['lsf_ccd'+str(ccd)], 
+                res_b = spectrum['lsf_b_ccd'+str(ccd)], 
+                synth = np.array([default_model_wave[wave_model_ccd], model_flux[wave_model_ccd]]).T,
+                initial_l=initial_l['ccd'+str(ccd)],
+                synth_res=300000.0,
+                reuse_initial_res_wave_grid = True
+            )
+
+        if rv_derivative:
+            fluxes[index], flux_wavelength_derivative = cubic_spline_interpolate(
+                rv_shift(-rv,wave_model_ccd_lsf),
+                model_ccd_lsf,
+                spectrum['wave_ccd'+str(ccd)],
+                return_derivative=True
+            )
+            # The shifted spline equals the unshifted one evaluated at wave * (1 - rv/c)
+            flux_rv_derivatives[index] = -flux_wavelength_derivative * spectrum['wave_ccd'+str(ccd)] / (299792.458 - rv)
+        else:
+            fluxes[index] = cubic_spline_interpolate(
+                rv_shift(-rv,wave_model_ccd_lsf),
+                model_ccd_lsf,
+                spectrum['wave_ccd'+str(ccd)]
+            )
+
+    if rv_derivative:
+        return fluxes, flux_rv_derivatives
+    return fluxes
+
+def degrade_to_observed_wavelength_fused(spectrum, ccd, model_fluxes, rvs, rv_derivative=False, models_ccd_lsf=None):
+    """
+    degrade_to_observed_wavelength for a CCD with a precomputed operator (see build_degradation_operators).
+    The stacked spectra are broadened in one product and one FFT on the precomputed slice of the emulator grid, unless already broadened spectra are given (models_ccd_lsf, see apply_batched_degradation).
+    The splines are fitted on the unshifted grid:
+    a cubic spline through the shifted grid rv_shift(-rv, l) = l / (1 - rv/c) is the same spline evaluated at wave * (1 - rv/c), so no shifted grids are built.
+    """
+    degradation_operator = degradation_operators['ccd'+str(ccd)]
+    wave = spectrum['wave_ccd'+str(ccd)]
+    check_rv_margin(degradation_operator, rvs)
+
+    if models_ccd_lsf is None:
+        models_ccd_lsf = apply_degradation_operator(degradation_operator, model_fluxes)
+    models_ccd_lsf = np.ascontiguousarray(models_ccd_lsf)
+
+    shifts = 1 - np.asarray(rvs, dtype=float) / 299792.458
+
+    # All spectra are resampled together, only at the observed pixels
+    if resampling_points is not None:
+        points = shifts[:, np.newaxis] * wave
+        if rv_derivative:
+            fluxes, flux_wavelength_derivatives = lagrange_resample(degradation_operator['wave'], models_ccd_lsf, points, resampling_points, derivative=True)
+            return fluxes, -flux_wavelength_derivatives * wave / 299792.458
+        return lagrange_resample(degradation_operator['wave'], models_ccd_lsf, points, resampling_points)
+
+    fluxes = np.empty((len(rvs), len(wave)))
+    flux_rv_derivatives = np.empty_like(fluxes)
+    for index, shift in enumerate(shifts):
+        # One spline per spectrum: scipy's CubicSpline is slower for several columns at once than for each column separately
+        spline = scipy.interpolate.CubicSpline(degradation_operator['wave'], models_ccd_lsf[index])
+        points = shift * wave
+        fluxes[index] = spline(points)
+        if rv_derivative:
+            # d/drv of spline(wave * (1 - rv/c))
+            flux_rv_derivatives[index] = -spline(points, 1) * wave / 299792.458
+
+    if rv_derivative:
+        return fluxes, flux_rv_derivatives
+    return fluxes
+
+def lagrange_resample(grid, values, points, n_points=6, derivative=False):
+    """
+    Local Lagrange interpolation on a fixed, sorted grid. Each point uses the n_points grid points around it (n_points even),
+    so the cost scales with the number of points rather than the size of the grid.
+
+    INPUT:
+    grid: (n_grid) sorted wavelengths
+    values: (K, n_grid) spectra on the grid
+    points: (K, n) wavelengths at which to evaluate each spectrum
+    derivative: also return d(values)/d(wavelength) of the interpolant
+
+    OUTPUT:
+    (K, n) interpolated values (and derivatives)
+    """
+    half = n_points // 2
+
+    # Stencils are kept on the grid, i.e. points beyond the edges are extrapolated with the outermost polynomial
+    interval = np.clip(np.searchsorted(grid, points, side='right') - 1, half - 1, len(grid) - half - 1)
+    stencil = interval[..., np.newaxis] + np.arange(1 - half, half + 1)
+    nodes = grid[stencil]
+    stencil_values = values[np.arange(len(values))[:, np.newaxis, np.newaxis], stencil]
+
+    # Lagrange basis: weights[j] = prod_{k != j} (point - node_k) / (node_j - node_k)
+    offsets = points[..., np.newaxis] - nodes
+    separations = [[nodes[..., j] - nodes[..., k] for k in range(n_points)] for j in range(n_points)]
+    weights = np.ones_like(nodes)
+    for j in range(n_points):
+        for k in range(n_points):
+            if k != j:
+                weights[..., j] *= offsets[..., k] / separations[j][k]
+    # The weights are computed from the wavelengths in float64, but applied in the precision of the values
+    interpolated = np.sum(weights.astype(values.dtype, copy=False) * stencil_values, axis=-1)
+
+    if not derivative:
+        return interpolated
+
+    # d(weights[j])/d(point) = sum_{l != j} 1 / (node_j - node_l) * prod_{k != j, l} (point - node_k) / (node_j - node_k)
+    derivative_weights = np.zeros_like(nodes)
+    for j in range(n_points):
+        for l in range(n_points):
+            if l == j:
+                continue
+            term = 1 / separations[j][l]
+            for k in range(n_points):
+                if k != j and k != l:
+                    term = term * offsets[..., k] / separations[j][k]
+            derivative_weights[..., j] += term
+
+    return interpolated, np.sum(derivative_weights.astype(values.dtype, copy=False) * stencil_values, axis=-1)
+
+def validate_resampling(spectrum, model_fluxes, rvs, n_points=None, threshold=1e-5):
+    """
+    Compares the local Lagrange resampling (resampling_points, or n_points) with the cubic spline through the whole grid for all CCDs with a precomputed operator.
+    Returns the maximum absolute flux deviation per CCD and prints a warning if one exceeds the threshold.
+    """
+    global resampling_points
+    configured_points = resampling_points
+
+    deviations = dict()
+    try:
+        for ccd in spectrum['available_ccds']:
+            if 'ccd'+str(ccd) not in degradation_operators:
+                continue
+            resampling_points = None
+            reference = degrade_to_observed_wavelength_fused(spectrum, ccd, model_fluxes, rvs)
+            resampling_points = configured_points if n_points is None else n_points
+            deviations['ccd'+str(ccd)] = float(np.max(np.abs(degrade_to_observed_wavelength_fused(spectrum, ccd, model_fluxes, rvs) - reference)))
+    finally:
+        resampling_points = configured_points
+
+    if any(deviation > threshold for deviation in deviations.values()):
+        print('Warning: resampling deviates from the cubic spline by more than ' + str(threshold) + ': ' + str(deviations))
+    return deviations
+
+def validate_model_precision(model, spectrum, precision=np.float32, threshold=1e-4):
+    """
+    Compares the binary model flux (emulator, broadening, resampling and f_contr mix) computed in precision with the float64 result for the current parameters of model.
+    Returns the maximum absolute flux deviation per CCD and prints a warning if one exceeds the threshold.
+    """
+    global model_precision
+    configured_precision = model_precision
+
+    model.interpolate()
+    component_parameters = [model.get_component_params(1), model.get_component_params(2)]
+    rvs = [model.params['rv_1'], model.params['rv_2']]
+
+    model_fluxes = dict()
+    try:
+        for tested_precision in [np.float64, precision]:
+            model_precision = tested_precision
+            component_models = create_synthetic_spectra(component_parameters, model.get_unique_labels())
+            # Copies, as the compiled backend reuses its output buffers
+            model_fluxes[np.dtype(tested_precision).name] = {key: np.array(flux) for key, flux in combine_component_fluxes(spectrum, component_models, rvs, model.params['f_contr']).items()}
+    finally:
+        model_precision = configured_precision
+
+    reference, tested = model_fluxes['float64'], model_fluxes[np.dtype(precision).name]
+    deviations = {key: float(np.max(np.abs(tested[key].astype(np.float64) - reference[key]))) for key in reference}
+
+    if any(deviation > threshold for deviation in deviations.values()):
+        print('Warning: ' + np.dtype(precision).name + ' model flux deviates from float64 by more than ' + str(threshold) + ': ' + str(deviations))
+    return deviations
+
+def degrade_to_observed_wavelength_all_ccds(spectrum, model_fluxes, rvs, rv_derivative=False):
+    """
+    degrade_to_observed_wavelength for every available CCD, with all CCDs broadened in one FFT if batched_convolution_layout covers them.
+    Returns a list with one result per CCD in the order of spectrum['available_ccds'].
+    """
+    if batched_convolution_layout is None or batched_convolution_layout['ccds'] != list(spectrum['available_ccds']):
+        return [degrade_to_observed_wavelength(spectrum, ccd, model_fluxes, rvs, rv_derivative) for ccd in spectrum['available_ccds']]
+
+    models_lsf = apply_batched_degradation(np.asarray(model_fluxes))
+    return [
+        degrade_to_observed_wavelength_fused(spectrum, ccd, model_fluxes, rvs, rv_derivative, models_ccd_lsf=models_lsf['ccd'+str(ccd)])
+        for ccd in spectrum['available_ccds']
+    ]
+
+def combine_component_fluxes(spectrum, component_models, rvs, f_contr):
+    """
+    Returns the binary model flux f_contr * component_1 + (1-f_contr) * component_2 at the observed wavelengths.
+    The result is a dictionary keyed by 'ccd'+str(ccd) for each available CCD.
+    """
+    if compiled_backend_available(spectrum):
+        return combine_component_fluxes_compiled(spectrum, component_models, rvs, f_contr)
+
+    model_flux = dict()
+    for ccd, component_models_at_observed_wavelength in zip(spectrum['available_ccds'], degrade_to_observed_wavelength_all_ccds(spectrum, component_models, rvs)):
+        model_flux['ccd'+str(ccd)] = f_contr * component_models_at_observed_wavelength[0] + (1-f_contr) * component_models_at_observed_wavelength[1]
+    return model_flux
+
+def compiled_backend_available(spectrum):
+    """ Whether combine_component_fluxes can use the compiled backend: numba is installed and selected, every CCD has a degradation operator and the resampling is local. """
+    return (
+        model_backend == 'numba' and numba is not None and resampling_points is not None and batched_convolution_layout is None
+        and all('ccd'+str(ccd) in degradation_operators for ccd in spectrum['available_ccds'])
+    )
+
+def compiled_buffer(degradation_operator, name, shape, dtype):
+    """ Returns a buffer for the compiled backend, kept in the degradation operator and reused as long as shape and dtype stay the same. """
+    buffers = degradation_operator.setdefault('compiled_buffers', dict())
+    key = (name, shape, np.dtype(dtype).name)
+    if key not in buffers:
+        buffers[key] = np.empty(shape, dtype=dtype)
+    return buffers[key]
+
+def combine_component_fluxes_compiled(spectrum, component_models, rvs, f_contr):
+    """
+    combine_component_fluxes with the compiled backend. Per CCD, the linear interpolation onto the degradation grid writes into the (preallocated) FFT input,
+    and the Lagrange resampling of both components and their f_contr mix write directly into the (preallocated) model flux. Only the FFTs allocate.
+    The returned arrays are these buffers, i.e. they are overwritten by the next call.
+    """
+    component_models = np.asarray(component_models)
+    shifts = 1 - np.asarray(rvs, dtype=float) / 299792.458
+    weights = np.array([f_contr, 1-f_contr], dtype=float)
+
+    model_flux = dict()
+    for ccd in spectrum['available_ccds']:
+        degradation_operator = degradation_operators['ccd'+str(ccd)]
+        wave = spectrum['wave_ccd'+str(ccd)]
+        check_rv_margin(degradation_operator, rvs)
+
+        new_f = compiled_buffer(degradation_operator, 'new_f', (len(component_models), degradation_operator['n_fft']), model_precision)
+        linear_interpolation_compiled(
+            degradation_operator['interpolation_left'], degradation_operator['interpolation_weight'],
+            component_models, operator_pixels(degradation_operator, component_models).start, new_f
+        )
+
+        con_f = scipy.fft.rfft(new_f, axis=-1)
+        con_f *= at_model_precision(degradation_operator, 'kernel_fft')
+        con_f = scipy.fft.irfft(con_f, degradation_operator['n_fft'], axis=-1)
+
+        flux = compiled_buffer(degradation_operator, 'flux', (len(wave),), float)
+        resample_and_mix_compiled(
+            degradation_operator['wave'], con_f[:, degradation_operator['offset']:degradation_operator['offset'] + degradation_operator['size']],
+            wave, shifts, weights, resampling_points, flux
+        )
+        model_flux['ccd'+str(ccd)] = flux
+    return model_flux
+
+def validate_compiled_backend(spectrum, model_fluxes, rvs, f_contr, threshold=1e-10):
+    """
+    Compares combine_component_fluxes with the compiled backend against the NumPy code for all available CCDs.
+    Returns the maximum absolute flux deviation per CCD and prints a warning if one exceeds the threshold.
+    """
+    global model_backend
+    configured_backend = model_backend
+
+    try:
+        model_backend = 'numpy'
+        reference = combine_component_fluxes(spectrum, model_fluxes, rvs, f_contr)
+        model_backend = 'numba'
+        if not compiled_backend_available(spectrum):
+            print('Warning: the compiled backend is not available (numba missing, no degradation operators, resampling_points None or batched_convolution set)')
+            return dict()
+        compiled = combine_component_fluxes(spectrum, model_fluxes, rvs, f_contr)
+    finally:
+        model_backend = configured_backend
+
+    deviations = {key: float(np.max(np.abs(compiled[key] - reference[key]))) for key in reference}
+
+    if any(deviation > threshold for deviation in deviations.values()):
+        print('Warning: compiled backend deviates from the NumPy code by more than ' + str(threshold) + ': ' + str(deviations))
+    return deviations
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def linear_interpolation_compiled(left, weight, model_fluxes, first_pixel, out):
+        # out[k] = interpolation @ model_fluxes[k, first_pixel:...], zero-padded to the length of out
+        for k in range(model_fluxes.shape[0]):
+            for i in range(left.shape[0]):
+                out[k, i] = (1 - weight[i]) * model_fluxes[k, first_pixel + left[i]] + weight[i] * model_fluxes[k, first_pixel + left[i] + 1]
+            out[k, left.shape[0]:] = 0
+
+    @numba.njit(cache=True)
+    def resample_and_mix_compiled(grid, values, wave, shifts, weights, n_points, out):
+        # out = sum_k weights[k] * lagrange_resample(grid, values[k], wave * shifts[k], n_points)
+        half = n_points // 2
+        n_grid = grid.shape[0]
+        out[:] = 0
+        for k in range(values.shape[0]):
+            interval = 0
+            for i in range(wave.shape[0]):
+                point = wave[i] * shifts[k]
+                # The observed wavelengths are sorted, so the interval only moves forward
+                while interval < n_grid - 1 and grid[interval + 1] <= point:
+                    interval += 1
+                start = min(max(interval, half - 1), n_grid - half - 1) - half + 1
+                interpolated = 0.0
+                for j in range(n_points):
+                    basis = 1.0
+                    for m in range(n_points):
+                        if m != j:
+                            basis *= (point - grid[start + m]) / (grid[start + j] - grid[start + m])
+                    interpolated += basis * values[k, start + j]
+                out[i] += weights[k] * interpolated
+
 def return_wave_data_sigma_model(model, spectrum, same_fe_h = True, use_solar_spectrum_mask = False):
     
     wave, data, sigma2, data_model, model = create_synthetic_binary_spectrum_at_observed_wavelength(model, spectrum, same_fe_h)
@@ -880,6 +2149,16 @@ def set_iterations(_n):
 
 
 # %%
+def count_iteration(model, spectrum):
+    # Plots the model every 50 evaluations of the optimisers
+    global iterations
+
+    iterations += 1
+    if iterations % 50 == 0:
+        model.generate_model(spectrum)
+        model.plot(title_text=str(iterations))
+        print(iterations, model.params)
+
 def get_flux_only(wave_init, model, spectrum, same_fe_h, unmasked, *model_parameters, plot=False):
     """
     This will be used as interpolation routine to give back a synthetic flux based on the curve_fit parameters
@@ -888,14 +2167,8 @@ def get_flux_only(wave_init, model, spectrum, same_fe_h, unmasked, *model_parame
     # THIS IS CRUCIAL -> UPDATE THE MODEL PARAMETERS. IDIOT.
     model.set_params(model_parameters)
 
-    global iterations
-    
     if plot:
-        iterations += 1
-        if iterations % 50 == 0:
-            model.generate_model(spectrum)
-            model.plot(title_text=str(iterations))
-            print(iterations, model.params)
+        count_iteration(model, spectrum)
 
     # Override f_contr with the value.
 
@@ -903,6 +2176,125 @@ def get_flux_only(wave_init, model, spectrum, same_fe_h, unmasked, *model_parame
 
     return(model_flux[unmasked])
 
+def create_synthetic_binary_spectrum_and_jacobian(model, spectrum):
+    """
+    Gradient-aware version of the binary model flux in create_synthetic_binary_spectrum_at_observed_wavelength.
+    Returns the model flux at the observed wavelengths of all available CCDs and its analytic Jacobian with respect to model.get_fit_labels().
+
+    Derivatives are propagated as follows:
+    - neural network labels: analytic emulator derivative, broadened and interpolated like the flux (these steps are linear in flux)
+    - rv: derivative of the interpolating spline
+    - f_contr: difference of the component fluxes
+    - mass, age, metallicity (if the isochrone is used): local slopes of the isochrone interpolation for teff, logg and logl (through f_contr if interpolate_flux)
+    Parameters that do not enter the model (e.g. teff when it is interpolated from the isochrone) have zero derivatives.
+    """
+    model.interpolate()
+
+    f_contr = model.params['f_contr']
+    rvs = [model.params['rv_1'], model.params['rv_2']]
+    weights = [f_contr, 1-f_contr]
+
+    fit_labels = model.get_fit_labels()
+    emulator_labels = ['teff', 'logg', 'fe_h', 'vmic', 'vsini']
+    isochrone_labels = ['mass', 'age', 'metallicity']
+    uses_isochrone = model.uses_isochrone()
+
+    component_models, component_jacobians = create_synthetic_spectra_and_jacobian(
+        [model.get_component_params(1), model.get_component_params(2)],
+        model.get_unique_labels()
+    )
+
+    if uses_isochrone:
+        isochrone_gradients = model.get_isochrone_gradients()
+
+    component_fluxes = []
+    component_rv_derivatives = []
+    component_derivatives = []
+    for component in [1, 2]:
+        suffix = '_' + str(component)
+        component_jacobian = component_jacobians[component-1]
+
+        # Derivative spectra on the emulator wavelength grid for each fit label of this component
+        derivative_labels = []
+        derivative_spectra = []
+        for label in fit_labels:
+            if label[-2:] != suffix:
+                continue
+            if label[:-2] in emulator_labels and not (uses_isochrone and label[:-2] in ['teff', 'logg']):
+                derivative_spectra.append(component_jacobian[:, emulator_labels.index(label[:-2])])
+            elif uses_isochrone and label[:-2] in isochrone_labels:
+                teff_gradient, logg_gradient = isochrone_gradients[component-1, :2, isochrone_labels.index(label[:-2])]
+                derivative_spectra.append(component_jacobian[:, 0] * teff_gradient + component_jacobian[:, 1] * logg_gradient)
+            else:
+                continue
+            derivative_labels.append(label)
+
+        # The flux and its derivatives are broadened and interpolated together
+        stacked_spectra = np.array([component_models[component-1]] + derivative_spectra)
+        degraded = degrade_to_observed_wavelength_all_ccds(spectrum, stacked_spectra, [rvs[component-1]] * len(stacked_spectra), rv_derivative=True)
+        fluxes = np.concatenate([flux for flux, rv_derivative in degraded], axis=1)
+
+        component_fluxes.append(fluxes[0])
+        component_rv_derivatives.append(np.concatenate([rv_derivative[0] for flux, rv_derivative in degraded]))
+        component_derivatives.append(dict(zip(derivative_labels, fluxes[1:])))
+
+    model_flux = weights[0] * component_fluxes[0] + weights[1] * component_fluxes[1]
+
+    jacobian = np.zeros((len(model_flux), len(fit_labels)))
+    for index, label in enumerate(fit_labels):
+        if label == 'f_contr':
+            if not (uses_isochrone and model.interpolate_flux):
+                jacobian[:, index] = component_fluxes[0] - component_fluxes[1]
+            continue
+        if label[-2:] not in ['_1', '_2']:
+            continue
+        component = int(label[-1])
+        if label[:-2] == 'rv':
+            jacobian[:, index] = weights[component-1] * component_rv_derivatives[component-1]
+        elif label in component_derivatives[component-1]:
+            jacobian[:, index] = weights[component-1] * component_derivatives[component-1][label]
+
+        # With interpolate_flux, f_contr = L_1 / (L_1 + L_2) also depends on the isochrone inputs through logl
+        if uses_isochrone and model.interpolate_flux and label[:-2] in isochrone_labels:
+            f_contr_logl_derivative = np.log(10) * f_contr * (1 - f_contr) * (1 if component == 1 else -1)
+            logl_gradient = isochrone_gradients[component-1, 2, isochrone_labels.index(label[:-2])]
+            jacobian[:, index] += (component_fluxes[0] - component_fluxes[1]) * f_contr_logl_derivative * logl_gradient
+
+    return model_flux, jacobian
+
+def get_flux_jacobian(wave_init, model, spectrum, same_fe_h, unmasked, *model_parameters):
+    """
+    Jacobian of get_flux_only with respect to the fitted parameters. Use as jac= for curve_fit.
+    See create_synthetic_binary_spectrum_and_jacobian for how the derivatives are computed.
+    """
+    model.set_params(model_parameters)
+
+    model_flux, jacobian = create_synthetic_binary_spectrum_and_jacobian(model, spectrum)
+
+    return(jacobian[unmasked])
+
+def get_rchi2_and_gradient(model, spectrum):
+    """
+    model.get_rchi2() after model.generate_model(spectrum), and its gradient with respect to model.get_fit_labels(), from one evaluation of create_synthetic_binary_spectrum_and_jacobian.
+    The observed flux is renormalised with the model flux, so the residuals depend on the parameters through both (see renormalised_flux_jacobian).
+    Leaves the model and the spectrum as model.generate_model(spectrum) does.
+    """
+    model_flux, jacobian = create_synthetic_binary_spectrum_and_jacobian(model, spectrum)
+
+    ccd_ends = np.cumsum([len(spectrum['wave_ccd'+str(ccd)]) for ccd in spectrum['available_ccds']])
+    renormalise_observed_flux(spectrum, dict(zip(['ccd'+str(ccd) for ccd in spectrum['available_ccds']], np.split(model_flux, ccd_ends[:-1]))))
+
+    model.wavelengths = rv_shift(model.params['rv_1'], np.concatenate([spectrum['wave_ccd'+str(ccd)] for ccd in spectrum['available_ccds']]))
+    model.flux = np.concatenate([spectrum['flux_obs_ccd'+str(ccd)] for ccd in spectrum['available_ccds']])
+    model.model_flux = model_flux
+
+    data_jacobian = np.concatenate([
+        renormalised_flux_jacobian(spectrum, ccd, ccd_jacobian)
+        for ccd, ccd_jacobian in zip(spectrum['available_ccds'], np.split(jacobian, ccd_ends[:-1]))
+    ])
+
+    return model.get_rchi2(), 2 * (jacobian - data_jacobian).T @ (model.model_flux - model.flux) / (len(model.flux) - len(model.params))
+
 # %%
 def load_dr3_lines(mode_dr3_path = 'galah_dr4_important_lines'):
     global important_lines, important_molecules
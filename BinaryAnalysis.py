@@ -7,6 +7,7 @@ from pathlib import Path
 import logging
 import importlib
 import mysql.connector
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 pd.set_option('display.max_columns', None)
@@ -48,11 +49,10 @@ def denormalize_parameters(normalized_params, bounds):
 sys.path.append(os.path.join(working_directory, 'utils'))
 import AstroPandas as ap
 
-isochrone_table = Table.read(working_directory +  '/assets/parsec_isochrones_logt_8p00_0p01_10p17_mh_m2p75_0p25_m0p75_mh_m0p60_0p10_0p70_GaiaEDR3_2MASS.fits')
+# Memory-mapped isochrone interpolator, shared with the other workers through the page cache. Its grid ranges replace reading the PARSEC table.
 isochrone_interpolator = af.load_isochrones()
+isochrone_ranges = isochrone_interpolator.get_ranges()
 
-sobject_id = int(sys.argv[1])
-tmass_id = str(sys.argv[2])
 
 
 def fit_model_OLD(sobject_id):
@@ -82,13 +82,13 @@ def fit_model_OLD(sobject_id):
     model.set_bounds('vmic', (0, 4))
     model.set_bounds('vsini', (0, 30))
 
-    age_min = (10**isochrone_table['logAge'].min()) / 1e9
-    age_max = (10**isochrone_table['logAge'].max()) / 1e9
+    age_min = (10**isochrone_ranges['logAge'][0]) / 1e9
+    age_max = (10**isochrone_ranges['logAge'][1]) / 1e9
 
     model.set_bounds('age', (age_min, age_max))
-    model.set_bounds('mass', (isochrone_table['mass'].min(), isochrone_table['mass'].max()))
-    model.set_bounds('metallicity', (isochrone_table['m_h'].min(), isochrone_table['m_h'].max()))
-    model.set_bounds('logL', (isochrone_table['logL'].min(), isochrone_table['logL'].max()))
+    model.set_bounds('mass', isochrone_ranges['mass'])
+    model.set_bounds('metallicity', isochrone_ranges['m_h'])
+    model.set_bounds('logL', isochrone_ranges['logL'])
 
     model.params['f_contr'] = 0.5
 
@@ -159,18 +159,111 @@ def fit_model_OLD(sobject_id):
 
 
 
-def fit_model(sobject_id):
-    spectrum = af.read_spectrum(sobject_id, tmass_id)
-    if spectrum == False:
-        return
+# Structured outcome of one fit, returned to the campaign driver (BinaryAnalysis_Init) instead of parsing stdout.
+# Status codes as in the tracker: 2 - Completed, -1 - Failed
+def fit_result(sobject_id, status, model=None, error=None):
+    result = {'sobject_id': sobject_id, 'status': status, 'residual': None, 'rchi2': None, 'params': None, 'error': error}
+    if model is not None:
+        result['residual'] = model.get_residual()
+        result['rchi2'] = model.get_rchi2()
+        result['params'] = dict(model.get_params())
+    return result
 
-    same_fe_h = False
+
+# The single-star results used by fit_model, consolidated for all objects of a campaign into one structured array sorted by sobject_id (see consolidate_single_results)
+single_results_columns = ['rv_gauss', 'rv_peak_2', 'teff', 'logg', 'fe_h']
+single_results_path = working_directory + '/assets/single_fit_results.npy'
+single_results_table = None
+single_results_rows = None
+
+
+def single_results_file(sobject_id):
+    return '/avatar/buder/GALAH_DR4/analysis_products_single/'+str(sobject_id)[:6]+'/'+str(sobject_id)+'/'+str(sobject_id)+'_single_fit_results.fits'
+
+
+# Returns the single-star results of one object as a one row table (False if not available), from the consolidated table if it has the object
+def read_single_results(sobject_id):
+    table, rows = load_single_results_table()
+    if rows is not None and int(sobject_id) in rows:
+        row = rows[int(sobject_id)]
+        return table[row:row + 1]
 
     try:
-        single_results = Table.read('/avatar/buder/GALAH_DR4/analysis_products_single/'+str(sobject_id)[:6]+'/'+str(sobject_id)+'/'+str(sobject_id)+'_single_fit_results.fits')
+        return Table.read(single_results_file(sobject_id))
     except:
         print('Single results not available')
-        return
+        return False
+
+
+# Memory-maps the consolidated single-star results once per process and indexes the rows by sobject_id
+def load_single_results_table():
+    global single_results_table, single_results_rows
+
+    if single_results_table is None and os.path.exists(single_results_path):
+        single_results_table = np.load(single_results_path, mmap_mode='r')
+        single_results_rows = {int(sobject_id): row for row, sobject_id in enumerate(single_results_table['sobject_id'])}
+
+    return single_results_table, single_results_rows
+
+
+def read_single_results_row(sobject_id):
+    try:
+        table = Table.read(single_results_file(sobject_id))
+    except:
+        return None
+    # Masked values (e.g. no second rv peak) become NaN
+    return (int(sobject_id),) + tuple(float(np.ma.filled(np.ma.asarray(table[column][0], dtype=float), np.nan)) for column in single_results_columns)
+
+
+def consolidate_single_results(sobject_ids, threads=16):
+    """
+    One-time step before a campaign: gathers the single-star results used by fit_model for all objects into one structured .npy,
+    so that jobs look them up instead of each opening its own FITS file. Objects already in the table are not read again,
+    objects without single results are left out (and still reported as not available by read_single_results).
+    """
+    global single_results_table, single_results_rows
+
+    table, rows = load_single_results_table()
+    new_sobject_ids = [sobject_id for sobject_id in dict.fromkeys(int(sobject_id) for sobject_id in sobject_ids) if rows is None or sobject_id not in rows]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        new_rows = [row for row in executor.map(read_single_results_row, new_sobject_ids) if row is not None]
+
+    dtype = [('sobject_id', 'i8')] + [(column, 'f8') for column in single_results_columns]
+    new_table = np.array(new_rows, dtype=dtype)
+    if table is not None:
+        new_table = np.concatenate([np.array(table), new_table])
+    new_table = new_table[np.argsort(new_table['sobject_id'], kind='stable')]
+
+    with af.atomic_write_file(single_results_path) as f:
+        np.save(f, new_table)
+
+    single_results_table, single_results_rows = None, None
+    print('Consolidated single results: ' + str(len(new_rows)) + ' added, ' + str(len(new_table)) + ' objects in total')
+    return load_single_results_table()[0]
+
+
+# Reads everything fit_model needs from disk: the spectrum (False if not available) and the single-star results (False if not available).
+# The neural network is loaded by fit_model itself, so this can run anywhere, e.g. in the prefetch threads of BinaryAnalysis_Init.
+def load_inputs(sobject_id, tmass_id):
+    spectrum = af.read_spectrum(sobject_id, tmass_id, load_model=False)
+    single_results = read_single_results(sobject_id)
+    return spectrum, single_results
+
+
+# spectrum and single_results can be passed in if they were read beforehand (see load_inputs). Otherwise they are read here.
+def fit_model(sobject_id, tmass_id, age, mass, m_h, spectrum=None, single_results=None):
+    if spectrum is None:
+        spectrum = af.read_spectrum(sobject_id, tmass_id, load_model=False)
+    if spectrum == False:
+        return fit_result(sobject_id, -1, error='Spectrum not available')
+
+    same_fe_h = False
+
+    if single_results is None:
+        single_results = read_single_results(sobject_id)
+    if single_results is False:
+        return fit_result(sobject_id, -1, error='Single results not available')
 
     # model = StellarModel(labels = ['teff', 'logg', 'rv', 'fe_h', 'vmic', 'vsini']) # Model with no interpolation
     model = StellarModel(id=sobject_id, labels = ['mass', 'age', 'metallicity', 'rv', 'fe_h', 'vmic', 'vsini'], interpolator=isochrone_interpolator, interpolate_flux=True) # Flux can be used as a free parameter (False) or can be determined from luminosity ratios (from the isochrone) (True)
@@ -185,13 +278,13 @@ def fit_model(sobject_id):
     model.set_bounds('vmic', (0, 4))
     model.set_bounds('vsini', (0, 30))
 
-    age_min = (10**isochrone_table['logAge'].min()) / 1e9
-    age_max = (10**isochrone_table['logAge'].max()) / 1e9
+    age_min = (10**isochrone_ranges['logAge'][0]) / 1e9
+    age_max = (10**isochrone_ranges['logAge'][1]) / 1e9
 
     model.set_bounds('age', (age_min, age_max))
-    model.set_bounds('mass', (isochrone_table['mass'].min(), isochrone_table['mass'].max()))
-    model.set_bounds('metallicity', (isochrone_table['m_h'].min(), isochrone_table['m_h'].max()))
-    model.set_bounds('logL', (isochrone_table['logL'].min(), isochrone_table['logL'].max()))
+    model.set_bounds('mass', isochrone_ranges['mass'])
+    model.set_bounds('metallicity', isochrone_ranges['m_h'])
+    model.set_bounds('logL', isochrone_ranges['logL'])
 
     model.params['f_contr'] = 0.5
 
@@ -200,7 +293,7 @@ def fit_model(sobject_id):
     model.params['rv_2'] = single_results['rv_peak_2'][0]
     if np.isnan(model.params['rv_2']) or str(model.params['rv_2']) == "--":
         print("No RV2 value!")
-        return
+        return fit_result(sobject_id, -1, error='No RV2 value!')
 
     min_rv = min(model.params['rv_1'], model.params['rv_2']) - 100
     max_rv = max(model.params['rv_1'], model.params['rv_2']) + 100
@@ -209,19 +302,20 @@ def fit_model(sobject_id):
     model.set_param('teff', single_results['teff'][0]/1000.)
     model.set_param('logg', single_results['logg'][0])
 
-    model.set_param('age', float(sys.argv[3]))
-    model.set_param('mass', float(sys.argv[4]))
-    model.set_param('metallicity', float(sys.argv[5])) # Approximate m_h as fe_h
+    model.set_param('age', float(age))
+    model.set_param('mass', float(mass))
+    model.set_param('metallicity', float(m_h)) # Approximate m_h as fe_h
 
     model.set_bounds('age', (age_min, age_max))
-    model.set_bounds('mass', (isochrone_table['mass'].min(), isochrone_table['mass'].max()))
-    model.set_bounds('metallicity', (isochrone_table['m_h'].min(), isochrone_table['m_h'].max()))
+    model.set_bounds('mass', isochrone_ranges['mass'])
+    model.set_bounds('metallicity', isochrone_ranges['m_h'])
 
     model.set_param('fe_h', single_results['fe_h'][0])
     model.set_param('vmic', 1.5)
     model.set_param('vsini', 4.0)
 
-    af.load_neural_network(spectrum)
+    # The emulator output is pruned to the wavelengths the rv bounds can reach
+    af.load_neural_network(spectrum, rv_margin=max(abs(min_rv), abs(max_rv)))
     af.set_iterations(0)
     af.load_dr3_lines()
     
@@ -236,26 +330,18 @@ def fit_model(sobject_id):
 
 
 
-    def objective_function_norm(normalized_params):
-
-        global previous_params
+    def objective_and_gradient_norm(normalized_params):
 
         # Denormalize the parameters
         model_parameters = denormalize_parameters(normalized_params, model.get_bounds(type='tuple'))
+        model.set_params(model_parameters)
+        af.count_iteration(model, spectrum)
 
-        # Calculate the model flux using the current parameters
-        model_flux = af.get_flux_only(wave_init, model, spectrum, same_fe_h, unmasked, *model_parameters, plot=True)
-        
-        # Need to generate a model with the current parameters to determine residual
-        model.generate_model(spectrum)
-        # residuals = model.get_residual()
-        residuals = model.get_rchi2()
-
+        # The reduced chi2 and its gradient come from one pass through the model. The gradient is chained through the normalisation of the parameters.
+        residuals, gradient = af.get_rchi2_and_gradient(model, spectrum)
+        denormalization = np.array([ub - lb for lb, ub in model.get_bounds(type='tuple')])
 
-        # print('Step ', np.array(normalized_params - previous_params))
-        previous_params = np.copy(normalized_params)
-        
-        return residuals
+        return residuals, gradient * denormalization
 
     # Fit the model to the data. This takes the model parameters and produces a synthetic spectra using the neural network. It then compares this to the observed data and adjusts the model parameters (and thereby the synthetic spectra from the NN) to minimize the difference between the two.
     kwargs={'maxfev':20000,'xtol':1e-5, 'gtol':1e-5, 'ftol':1e-5}
@@ -268,6 +354,8 @@ def fit_model(sobject_id):
         sigma=np.sqrt(sigma2_init[unmasked_init]),
         absolute_sigma=True,
         bounds=model.get_bounds(),
+        jac=lambda wave_init,
+            *model_parameters: af.get_flux_jacobian(wave_init, model, spectrum, same_fe_h, unmasked, *model_parameters),
         **kwargs
     )
 
@@ -296,9 +384,10 @@ def fit_model(sobject_id):
 
 
     result = scipy.optimize.minimize(
-        objective_function_norm,
+        objective_and_gradient_norm,
         x0=normalized_x0, #model.get_params(values_only=True),
         method='L-BFGS-B',
+        jac=True,
         bounds= bounds, #[(0, 1)] * len(bounds), #model.get_bounds(type='tuple'),
         # Ftol is the relative error desired in the sum of squares.
         # Gtol is the gradient norm desired in the sum of squares.
@@ -310,5 +399,12 @@ def fit_model(sobject_id):
     params_list = ', '.join(map(str, params))
     print(model.get_residual(), model.get_rchi2(), params_list)
 
+    return fit_result(sobject_id, 2, model=model)
+
+
+if __name__ == "__main__":
+    # Command line use (one object per process): python BinaryAnalysis.py sobject_id tmass_id age mass m_h
+    sobject_id = int(sys.argv[1])
+    tmass_id = str(sys.argv[2])
 
-fit_model(sobject_id)
\ No newline at end of file
+    fit_model(sobject_id, tmass_id, sys.argv[3], sys.argv[4], sys.argv[5])
\ No newline at end of file
@@ -13,6 +13,10 @@ from datetime import datetime
 import subprocess
 import pandas as pd
 import json
+import queue
+import resource
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 
 # Scipy
@@ -20,7 +24,6 @@ import scipy
 from scipy.optimize import curve_fit
 from scipy import signal
 
-from astropy.table import Table
 import AnalysisFunctions as af
 import multiprocessing
 from multiprocessing.pool import ThreadPool as Pool
@@ -32,14 +35,28 @@ import AstroPandas as ap
 import stellarmodel
 from stellarmodel import StellarModel
 
-# Accepts mass, log(age), metallicity. Outputs Teff, logg, and log(L) bolometric (flux)
-isochrone_table = Table.read(working_directory +  '/assets/parsec_isochrones_logt_8p00_0p01_10p17_mh_m2p75_0p25_m0p75_mh_m0p60_0p10_0p70_GaiaEDR3_2MASS.fits')
-isochrone_interpolator = af.load_isochrones()
-
 tracker_path = '/home/yanilach/public_html/avatar-tracker/'
 
 file_lock = multiprocessing.Lock()
 
+# Persistent worker processes. Each loads the isochrones, emulator and other assets once and fits many objects,
+# and is replaced after worker_max_tasks fits or once its peak memory use exceeds worker_max_rss_mb.
+use_worker_pool = True
+worker_max_tasks = 50
+worker_max_rss_mb = 8000
+# Objects handed to a worker that died before announcing them are failed once no message has arrived for this many seconds and no fit is in progress
+worker_stall_timeout = 600
+
+# The spectra and single-star results of the next prefetch_depth objects are read by prefetch_threads I/O threads while the current fits run.
+# Set prefetch_depth to 0 to let each worker read its own inputs.
+prefetch_depth = 16
+prefetch_threads = 4
+
+# The workers are started by a fork server rather than forked from the driver, whose prefetch threads may hold locks (I/O, logging, BLAS) at any time.
+# The server imports this script and BinaryAnalysis once, so every worker still starts with the assets loaded.
+worker_context = multiprocessing.get_context('forkserver')
+worker_context.set_forkserver_preload(['__main__', 'BinaryAnalysis'])
+
 
 def edit_tracker(key, vals):
     # Step 1: Load existing data from JSON file (if it exists)
@@ -168,6 +185,229 @@ def run_script(args):
         print("Error message:", e.stderr)
         update_tracker([object_id], -1, err=e.stderr)
 
+# Peak resident memory of this process in MB (ru_maxrss is in kB on Linux)
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def worker_loop(task_queue, result_queue, max_tasks, max_rss_mb):
+    # Imported once per worker. Loads the isochrone interpolator and the other module level assets.
+    import BinaryAnalysis
+
+    for completed in range(max_tasks):
+        # Time spent waiting for the next (prefetched) object
+        wait_start = time.time()
+        task = task_queue.get()
+        wait_time = time.time() - wait_start
+        if task is None:
+            break
+
+        object_id, tmass_id, age, mass, m_h, inputs, prefetch_time = task
+        result_queue.put(('start', os.getpid(), object_id))
+
+        # AnalysisFunctions calls exit() for some missing files, so SystemExit is a failed fit rather than the end of the worker
+        io_time = 0.0
+        fit_start = time.time()
+        try:
+            if not inputs:
+                spectrum, single_results = BinaryAnalysis.load_inputs(object_id, tmass_id)
+                inputs = {'spectrum': spectrum, 'single_results': single_results}
+                io_time = time.time() - fit_start
+
+            result = BinaryAnalysis.fit_model(object_id, tmass_id, age, mass, m_h, **inputs)
+            if result is None:
+                result = BinaryAnalysis.fit_result(object_id, -1, error='No result returned')
+        except (Exception, SystemExit) as e:
+            result = BinaryAnalysis.fit_result(object_id, -1, error=repr(e))
+
+        result.update({'prefetch_time': prefetch_time, 'io_time': io_time, 'wait_time': wait_time, 'fit_time': time.time() - fit_start - io_time})
+        result_queue.put(('result', os.getpid(), result))
+
+        if peak_rss_mb() > max_rss_mb:
+            break
+
+    result_queue.put(('exit', os.getpid(), None))
+
+
+# Runs in the I/O threads of the driver. Adds the inputs read for the object and the time taken to the task.
+def prefetch_inputs(task):
+    import BinaryAnalysis
+
+    start = time.time()
+    try:
+        spectrum, single_results = BinaryAnalysis.load_inputs(task[0], task[1])
+        inputs = {'spectrum': spectrum, 'single_results': single_results}
+    except (Exception, SystemExit):
+        # Leave it to the worker to read (and report) this object
+        inputs = {}
+
+    return tuple(task) + (inputs, time.time() - start)
+
+
+# Totals over the fits: I/O in the prefetch threads (overlapped with fitting), blocking I/O in the workers, workers waiting for objects, and fitting
+def timing_summary(results):
+    summary = {key: float(sum(result.get(key, 0.0) for result in results)) for key in ['prefetch_time', 'io_time', 'wait_time', 'fit_time']}
+    print('Prefetch I/O: {prefetch_time:.1f}s, worker I/O: {io_time:.1f}s, waiting for objects: {wait_time:.1f}s, fitting: {fit_time:.1f}s'.format(**summary))
+    return summary
+
+
+# SimpleQueue.get has no timeout. Only the driver reads the result queue, so get() does not block once it is not empty.
+def get_message(result_queue, timeout):
+    end = time.time() + timeout
+    while result_queue.empty():
+        if time.time() >= end:
+            raise queue.Empty
+        time.sleep(0.01)
+    return result_queue.get()
+
+
+def start_worker(task_queue, result_queue, max_tasks, max_rss_mb):
+    worker = worker_context.Process(target=worker_loop, args=(task_queue, result_queue, max_tasks, max_rss_mb), daemon=True)
+    worker.start()
+    return worker
+
+
+def record_result(result):
+    object_id = result['sobject_id']
+
+    if result['status'] == 2:
+        params_list = ', '.join(map(str, result['params'].values()))
+        print(f"Fit completed for object_id {object_id}.")
+        update_tracker([object_id], 2)
+
+        with file_lock:
+            with open("fit_results.txt", "a") as f:
+                f.write(f"{object_id}, {result['residual']} {result['rchi2']} {params_list}\n")
+    else:
+        print(f"Fit failed for object_id {object_id}:", result['error'])
+        update_tracker([object_id], -1, err=result['error'])
+
+
+# Fits all objects on a pool of persistent worker processes. Returns the structured results of BinaryAnalysis.fit_model.
+def run_worker_pool(tasks, processes, max_tasks=None, max_rss_mb=None, prefetch_depth=None, prefetch_threads=None, stall_timeout=None):
+    max_tasks = worker_max_tasks if max_tasks is None else max_tasks
+    stall_timeout = worker_stall_timeout if stall_timeout is None else stall_timeout
+    max_rss_mb = worker_max_rss_mb if max_rss_mb is None else max_rss_mb
+    prefetch_depth = globals()['prefetch_depth'] if prefetch_depth is None else prefetch_depth
+    prefetch_threads = globals()['prefetch_threads'] if prefetch_threads is None else prefetch_threads
+
+    tasks = list(tasks)
+    task_queue = worker_context.Queue()
+    # Workers write to the result queue synchronously (a Queue sends from a feeder thread), so their 'start' is sent even if they are killed during the fit
+    result_queue = worker_context.SimpleQueue()
+
+    # Objects not yet prefetched, being prefetched, and handed to the workers but not started (by sobject_id)
+    pending = deque(tasks)
+    prefetching = []
+    queued = []
+    executor = ThreadPoolExecutor(max_workers=prefetch_threads) if prefetch_depth > 0 else None
+
+    def feed():
+        if executor is None:
+            while pending:
+                task = pending.popleft()
+                task_queue.put(tuple(task) + ({}, 0.0))
+                queued.append(task[0])
+            return
+
+        for future in [future for future in prefetching if future.done()]:
+            prefetching.remove(future)
+            task = future.result()
+            task_queue.put(task)
+            queued.append(task[0])
+
+        while pending and len(prefetching) + len(queued) < prefetch_depth:
+            prefetching.append(executor.submit(prefetch_inputs, pending.popleft()))
+
+    feed()
+
+    workers = {}
+    for _ in range(min(processes, len(tasks))):
+        worker = start_worker(task_queue, result_queue, max_tasks, max_rss_mb)
+        workers[worker.pid] = worker
+
+    # Object currently being fitted by each worker, so a worker that dies mid-fit fails only that object
+    in_progress = {}
+    results = []
+    # Workers that died outside of a fit (e.g. failing to import). Stop rather than respawning them forever.
+    failed_workers = 0
+    last_message = time.time()
+
+    def failed_result(object_id, error):
+        result = {'sobject_id': object_id, 'status': -1, 'residual': None, 'rchi2': None, 'params': None, 'error': error}
+        results.append(result)
+        record_result(result)
+
+    def handle(message, pid, content):
+        nonlocal last_message
+        last_message = time.time()
+        if message == 'start':
+            in_progress[pid] = content
+            if content in queued:
+                queued.remove(content)
+            update_tracker([content], 1)
+        elif message == 'result':
+            in_progress.pop(pid, None)
+            results.append(content)
+            record_result(content)
+        elif message == 'exit':
+            worker = workers.pop(pid, None)
+            if worker is not None:
+                worker.join()
+
+    while len(results) < len(tasks):
+        try:
+            # Poll more often while objects are being prefetched
+            handle(*get_message(result_queue, 0.1 if prefetching else 10))
+        except queue.Empty:
+            pass
+
+        feed()
+
+        dead_workers = [pid for pid, worker in workers.items() if not worker.is_alive()]
+        if dead_workers:
+            # Messages a worker sent before exiting are already in the queue
+            while not result_queue.empty():
+                handle(*result_queue.get())
+
+            for pid in dead_workers:
+                worker = workers.pop(pid, None)
+                if pid in in_progress:
+                    failed_result(in_progress.pop(pid), 'Worker exited with code ' + str(worker.exitcode if worker is not None else None))
+                elif worker is not None and worker.exitcode != 0:
+                    failed_workers += 1
+
+            if failed_workers >= processes:
+                raise RuntimeError("Worker processes are failing outside of fits. Run BinaryAnalysis.py directly to see the error.")
+
+        # A worker killed between taking an object and announcing it leaves the object queued for good (and holding a prefetch slot).
+        # With objects queued, none being prefetched or fitted and no message for stall_timeout, the idle workers would have started them,
+        # so they are failed and their prefetch slots are freed for the remaining objects.
+        if queued and not prefetching and not in_progress and time.time() - last_message > stall_timeout:
+            for object_id in list(queued):
+                failed_result(object_id, 'Lost by a worker that exited before starting the fit')
+            queued.clear()
+            last_message = time.time()
+            feed()
+            continue
+
+        # Replace workers that have been recycled or have died
+        remaining = len(tasks) - len(results) - len(in_progress)
+        while len(workers) < min(processes, remaining):
+            worker = start_worker(task_queue, result_queue, max_tasks, max_rss_mb)
+            workers[worker.pid] = worker
+
+    for _ in workers:
+        task_queue.put(None)
+    for worker in workers.values():
+        worker.join()
+
+    if executor is not None:
+        executor.shutdown()
+
+    return results
+
+
 if __name__ == "__main__":
 
     # Remove pending items from the web interface - starting again
@@ -189,9 +429,8 @@ if __name__ == "__main__":
     GALAH_DR4_dir = '/avatar/buder/GALAH_DR4/'
     GALAH_DR4 = ap.FitsToDF(GALAH_DR4_dir + "catalogs/galah_dr4_allspec_240207.fits")
 
-    # Accepts mass, log(age), metallicity. Outputs Teff, logg, and log(L) bolometric (flux)
-    isochrone_table = Table.read(working_directory +  '/assets/parsec_isochrones_logt_8p00_0p01_10p17_mh_m2p75_0p25_m0p75_mh_m0p60_0p10_0p70_GaiaEDR3_2MASS.fits')
-    isochrone_interpolator = af.load_isochrones()
+    # Only the grid ranges are needed here, for the age limits. The workers use the interpolator loaded by BinaryAnalysis.
+    isochrone_ranges = af.load_isochrones().get_ranges()
 
     # Results from CCF
     # results_text = pd.read_csv("/avatar/yanilach/PhD-Home/binaries_galah-main/spectrum_analysis" + "/CCF_results.txt", sep='\t', names=["sobject_id", "no_peaks", "RVs"])
@@ -211,8 +450,8 @@ if __name__ == "__main__":
     tmass_ids = binary_stars['tmass_id'].values
 
      # Params
-    age_min = (10**isochrone_table['logAge'].min()) / 1e9
-    age_max = (10**isochrone_table['logAge'].max()) / 1e9
+    age_min = (10**isochrone_ranges['logAge'][0]) / 1e9
+    age_max = (10**isochrone_ranges['logAge'][1]) / 1e9
 
     ages = binary_stars['age'].values.clip(age_min, age_max)
     masses = binary_stars['mass'].values
@@ -250,9 +489,17 @@ if __name__ == "__main__":
     # # Create a pool of worker processes. Max number here is 24 at home.
     num_cores_os = 30
 
-    with Pool(processes=num_cores_os) as pool:
-        # Run the scripts in parallel
-        pool.map(run_script, zip(object_ids, tmass_ids, ages, masses, m_hs))
+    if use_worker_pool:
+        # Single-star results of all objects in one table, instead of a FITS file per job
+        import BinaryAnalysis
+        BinaryAnalysis.consolidate_single_results(object_ids)
+
+        results = run_worker_pool(zip(object_ids, tmass_ids, ages, masses, m_hs), num_cores_os)
+        val['timing'] = timing_summary(results)
+    else:
+        with Pool(processes=num_cores_os) as pool:
+            # Run the scripts in parallel
+            pool.map(run_script, zip(object_ids, tmass_ids, ages, masses, m_hs))
 
     current_time = datetime.now().isoformat()  # e.g., '2024-09-11T14:23:45.123456'
     val['timestop'] = current_time
@@ -2,8 +2,65 @@ import numpy as np
 import matplotlib.pyplot as plt
 import AnalysisFunctions as af
 from pandas import DataFrame
+from collections.abc import Mapping, MutableMapping
 important_lines, important_molecules = af.load_dr3_lines()
 
+# Dictionary-like store of model parameters backed by one contiguous float64 array.
+# model.params['rv_1'] works as before, while model.params.array exposes all values at once (in insertion order) for vectorised access.
+# on_change is called whenever a label is added or removed. Adding a label beyond the capacity moves the values to a larger array, so views taken earlier no longer follow the parameters.
+class ParameterVector(MutableMapping):
+    def __init__(self, capacity=32, on_change=None):
+        self.index = {}
+        self._values = np.zeros(capacity, dtype=np.float64)
+        self.on_change = on_change
+
+    @property
+    def array(self):
+        return self._values[:len(self.index)]
+
+    def __getitem__(self, key):
+        return float(self._values[self.index[key]])
+
+    def __setitem__(self, key, value):
+        # Masked table entries (e.g. missing single-star results) are stored as NaN
+        if value is np.ma.masked:
+            value = np.nan
+
+        if key not in self.index:
+            if len(self.index) == len(self._values):
+                self._values = np.concatenate([self._values, np.zeros(len(self._values), dtype=np.float64)])
+            self.index[key] = len(self.index)
+            self._values[self.index[key]] = value
+            if self.on_change is not None:
+                self.on_change()
+            return
+
+        self._values[self.index[key]] = value
+
+    def __delitem__(self, key):
+        values = self.array.copy()
+        position = self.index.pop(key)
+        self.index = {label: i - (i > position) for label, i in self.index.items()}
+        self._values[:len(self.index)] = np.delete(values, position)
+        if self.on_change is not None:
+            self.on_change()
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+# Index into the parameter array: a slice (so the result is a view) when the indices are contiguous, otherwise an index array
+def parameter_index(indices):
+    indices = np.asarray(indices, dtype=int)
+    if len(indices) > 0 and np.all(np.diff(indices) == 1):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
 class StellarModel:
     interpolator = None
 
@@ -17,7 +74,7 @@ class StellarModel:
         self.model_labels = {}
         self.unique_labels = []
         self.bounds = {}
-        self.params = {}
+        self.params = ParameterVector()
         self.indices = {}
         self.unique_indices = {}
         self.wavelengths = []
@@ -62,6 +119,19 @@ class StellarModel:
         self.param_data = {key: [] for key in self.params.keys()}
         self.param_data['residual'] = []
 
+        self.update_indices()
+        # Labels added later (e.g. model.params['x'] = 1 or load_data) keep the indices up to date
+        self.params.on_change = self.update_indices
+
+    # Precomputes the free/fixed mask and the per-component positions in the parameter array. Called whenever a label is added or removed; call again if fixed_labels changes.
+    def update_indices(self):
+        labels = list(self.params.keys())
+        self.fit_mask = np.array([label.split('_')[0] not in self.fixed_labels for label in labels], dtype=bool)
+        self.fit_index = parameter_index(np.flatnonzero(self.fit_mask))
+        self.component_index = {}
+        for component in range(1, self.components + 1):
+            self.component_index[component] = parameter_index([i for i, label in enumerate(labels) if label.split('_')[-1] == str(component)])
+
     def save_data(self):
         for i, param in enumerate(self.params):
             self.param_data[param].append(self.params[param])
@@ -87,48 +157,67 @@ class StellarModel:
             # Outputs Teff, logg, and log(L) bolometric (flux)
 
             if all(label in self.unique_labels for label in ['mass']) and all(label in self.fixed_labels for label in ['age', 'metallicity']):
-                # Both components will have the same starting values.
+                # All components (and any number of them) are interpolated in one call.
                 # Provide the log of the age in Gyr for interpolation
-                # TODO Change this to be dynamic based on the number of components
-
-                # Star 1
-                interpolate_1 = self.interpolator(self.params['mass_1'], np.log10(self.params['age_1'] * 1e9), self.params['metallicity_1'])
-                # Star 2
-                interpolate_2 = self.interpolator(self.params['mass_2'], np.log10(self.params['age_2'] * 1e9), self.params['metallicity_2'])
-
-                # self.set_param('teff', (10 ** interpolate[0]) / 1000)
-                # self.set_param('logg', interpolate[1])
-                # self.set_param('logl', interpolate[2])
+                masses, log_ages, metallicities = self.get_isochrone_inputs()
+                interpolated = np.array(self.interpolator(masses, log_ages, metallicities)).reshape(self.components, 3)
 
-                self.params['teff_1'] = (10 ** interpolate_1[0]) / 1000
-                self.params['logg_1'] = interpolate_1[1]
-                self.params['logl_1'] = interpolate_1[2]
-
-                self.params['teff_2'] = (10 ** interpolate_2[0]) / 1000
-                self.params['logg_2'] = interpolate_2[1]
-                self.params['logl_2'] = interpolate_2[2]
+                teffs = (10 ** interpolated[:, 0]) / 1000
+                loggs = interpolated[:, 1]
+                logls = interpolated[:, 2]
 
                 # The optimiser has gone outside the bounds. Set parmaeters to unreasonable values. This should results in a high residual.
                 # Consider scaling parameters to prevent this in the optimiser (TODO)
-                if np.isnan(self.params['teff_1']) or np.isnan(self.params['teff_2']):
+                if np.any(np.isnan(teffs)):
                     # print("Interpolated values are NaN. Check input values for interpolation")
-                    self.params['teff_1'] = 0
-                    self.params['teff_2'] = 0
-                    self.params['logg_1'] = 0
-                    self.params['logg_2'] = 0
-                    self.params['logl_1'] = 0
-                    self.params['logl_2'] = 0
+                    teffs = np.zeros(self.components)
+                    loggs = np.zeros(self.components)
+                    logls = np.zeros(self.components)
                     # self.params['f_contr'] = 0.5
 
+                for i in range(self.components):
+                    self.params['teff_' + str(i+1)] = teffs[i]
+                    self.params['logg_' + str(i+1)] = loggs[i]
+                    self.params['logl_' + str(i+1)] = logls[i]
+
                 if self.interpolate_flux:
-                    f_1 = 10 ** self.params['logl_1']
-                    f_2 = 10 ** self.params['logl_2']
-                    flux_ratio = f_1 / (f_1 + f_2)
+                    # Flux ratio of the first component to the total
+                    fluxes = 10 ** logls
+                    flux_ratio = fluxes[0] / np.sum(fluxes)
                     self.params['f_contr'] = flux_ratio
 
             else:
                 print("Isochrone labels not found in model labels. Please add 'mass', 'age', and 'metallicity' to model labels for interpolation")
 
+    # True if teff, logg and logl are interpolated from the isochrone (mass, age, metallicity) rather than fitted directly
+    def uses_isochrone(self):
+        return self.interpolator is not None and all(label in self.unique_labels for label in ['mass']) and all(label in self.fixed_labels for label in ['age', 'metallicity'])
+
+    # Isochrone inputs (mass, log(age), metallicity) of all components as arrays
+    def get_isochrone_inputs(self):
+        suffixes = ['_' + str(i+1) for i in range(self.components)]
+        masses = np.array([self.params['mass' + suffix] for suffix in suffixes], dtype=float)
+        log_ages = np.log10(np.array([self.params['age' + suffix] for suffix in suffixes], dtype=float) * 1e9)
+        metallicities = np.array([self.params['metallicity' + suffix] for suffix in suffixes], dtype=float)
+        return masses, log_ages, metallicities
+
+    # Local slopes of the isochrone interpolation from central differences, evaluated for all components in one interpolator call.
+    # Returns an array of shape (components, 3, 3) of d(teff, logg, logl)/d(mass, age, metallicity) in model units (teff in 1000 K, age in Gyr). Call interpolate() first.
+    def get_isochrone_gradients(self, step=1e-4):
+        points = np.array(self.get_isochrone_inputs()).T
+        probes = np.concatenate([points[:, np.newaxis] + step * np.eye(3), points[:, np.newaxis] - step * np.eye(3)], axis=1).reshape(-1, 3)
+
+        values = np.array(self.interpolator(probes[:, 0], probes[:, 1], probes[:, 2])).reshape(self.components, 6, 3)
+        gradients = np.transpose((values[:, :3] - values[:, 3:]) / (2 * step), (0, 2, 1))
+
+        # Interpolator outputs log(Teff) and takes log(age)
+        suffixes = ['_' + str(i+1) for i in range(self.components)]
+        gradients[:, 0] *= np.log(10) * np.array([self.params['teff' + suffix] for suffix in suffixes], dtype=float)[:, np.newaxis]
+        gradients[:, :, 1] /= np.log(10) * np.array([self.params['age' + suffix] for suffix in suffixes], dtype=float)[:, np.newaxis]
+
+        # Outside of the isochrone grid the interpolation is NaN (and the model parameters are reset), so there is no slope
+        return np.nan_to_num(gradients, nan=0.0, posinf=0.0, neginf=0.0)
+
     # For single parameter retrieval (E.g. teff_1 not teff)
     def get_param(self, param):
         if param[:-2] in ['teff', 'logg', 'logg'] and self.interpolator is not None:
@@ -147,14 +236,17 @@ class StellarModel:
     def get_component_labels(self, component):
         return [label for label in self.model_labels.values() if label.split('_')[-1] == str(component)]
 
+    # Model labels we are trying to fit (in the order used by set_params)
+    def get_fit_labels(self):
+        return [label for label in self.model_labels if label.split('_')[0] not in self.fixed_labels]
+
     def get_params(self, values_only=False, exclude_fixed=False):
 
         if values_only:
             if exclude_fixed:
-                mask = [key.split('_')[0] not in self.fixed_labels for key in self.params.keys()]
-                return np.array([float(param) for param in self.params.values()])[mask]
+                return self.params.array[self.fit_mask]
             else:
-                return np.array([float(param) for param in self.params.values()])
+                return self.params.array.copy()
         else:
             if exclude_fixed:
                 return {key: value for key, value in self.params.items() if key.split('_')[0] not in self.fixed_labels}
@@ -170,23 +262,19 @@ class StellarModel:
 
     
     # Returns initial parameters as a dictionary without suffixes for each component. E.g. fe_h_1 = 1 -> fe_h = 1
+    # With values_only and nothing excluded, the values are a read-only view into the parameter array where the component labels are contiguous (take it again after adding or removing labels).
     def get_component_params(self, component, values_only=False, exclude=[]):
-        params = []
-        for label in self.get_component_labels(component):
-            if label[:-2] not in exclude:
-                params.append(float(self.params[label]))
+        params = self.params.array[self.component_index[component]]
+        if exclude:
+            params = params[[label not in exclude for label in self.get_unique_labels()]]
+        elif values_only and isinstance(self.component_index[component], slice):
+            params = params.view()
+            params.flags.writeable = False
 
         if values_only:
             return params
         else:
-            params_dict = {}
-            i = 0
-            for label in self.get_unique_labels():
-                if label not in exclude:
-                    params_dict[label] = params[i]
-                    i += 1
-
-            return params_dict
+            return {label: float(value) for label, value in zip([label for label in self.get_unique_labels() if label not in exclude], params)}
     
     # Returns the index of a label in the model_labels dictionary (Enum-ify)
     def label(self, label, comp=None):
@@ -230,20 +318,14 @@ class StellarModel:
         # print("TYPE ", type(params))
         # print("PARAMS: ", params)
 
-        if type(params) is dict:
-            for key, value in params.items():
-                self.params[key] = value
+        if isinstance(params, Mapping):
+            if params is not self.params:
+                for key, value in params.items():
+                    self.params[key] = value
         else:
-            # This is an array of values.
-            #  Model labels we are trying to fit
-            fit_labels = [label for label in self.model_labels if label.split('_')[0] not in self.fixed_labels]
-            
-            # print(fit_labels, len(fit_labels))
-            # print(fit_labels, self.model_labels, self.fixed_labels)
-
-            if len(fit_labels) == len(params):
-                for i, label in enumerate(fit_labels):
-                    self.params[label] = params[i]
+            # This is an array of values for the model labels we are trying to fit (see get_fit_labels)
+            if len(params) == np.count_nonzero(self.fit_mask):
+                self.params.array[self.fit_index] = params
             else:
                 raise ValueError("Error: trying to set all parameters at once but the number of parameters does not match the number of labels in the model.")
 
@@ -256,6 +338,8 @@ class StellarModel:
             if param not in self.fixed_labels:
                 self.bounds[param + '_' + str(i+1)] = (-1e10, 1e10)
 
+        self.update_indices()
+
     def generate_model(self, spectrum):
         self.wavelengths, self.flux, sigma2_iter1, self.model_flux, unmasked_iter1 = af.return_wave_data_sigma_model(self, spectrum, same_fe_h = False) 
         
@@ -0,0 +1,81 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Wavelength ranges of the four CCDs of the synthetic emulator
+ccd_ranges = {1: (4700., 4910.), 2: (5640., 5885.), 3: (6470., 6745.), 4: (7670., 7895.)}
+
+
+@pytest.fixture(scope='session')
+def af():
+    # AnalysisFunctions changes into the pipeline's working directory on import, which only exists on the analysis machine
+    chdir = os.chdir
+    os.chdir = lambda path: chdir(path) if os.path.isdir(path) else None
+    try:
+        import AnalysisFunctions
+    finally:
+        os.chdir = chdir
+    return AnalysisFunctions
+
+
+@pytest.fixture(scope='session')
+def stellarmodel(af):
+    # stellarmodel reads the line list of the analysis machine on import
+    load_dr3_lines = af.load_dr3_lines
+    af.load_dr3_lines = lambda: ([], [])
+    try:
+        import stellarmodel
+    finally:
+        af.load_dr3_lines = load_dr3_lines
+    return stellarmodel
+
+
+@pytest.fixture(scope='module')
+def pipeline(af):
+    """
+    Small random emulator on a 0.01 A grid and a synthetic four-CCD spectrum, with the degradation operators and pruned emulator output as set up by load_neural_network.
+    Returns the spectrum and the emulator fluxes of two stars.
+    """
+    rng = np.random.default_rng(0)
+
+    default_model_wave = np.concatenate([np.arange(start, end, 0.01) for start, end in ccd_ranges.values()])
+    n_pixels, n_hidden = len(default_model_wave), 30
+    model_components = (
+        rng.normal(size=(n_hidden, 5)), rng.normal(size=(n_hidden, n_hidden)) / 5, rng.normal(size=(n_pixels, n_hidden)) / 30,
+        rng.normal(size=n_hidden), rng.normal(size=n_hidden), np.ones(n_pixels),
+        np.array([3000., 0., -4., 0., 0.]), np.array([8000., 5., 1., 4., 30.])
+    )
+
+    spectrum = {'sobject_id': 1, 'available_ccds': [1, 2, 3, 4]}
+    for ccd, (start, end) in ccd_ranges.items():
+        wave = np.arange(start + 20, end - 20, 0.046)
+        spectrum['crval_ccd'+str(ccd)] = wave[0]
+        spectrum['cdelt_ccd'+str(ccd)] = 0.046
+        spectrum['wave_ccd'+str(ccd)] = wave
+        spectrum['counts_ccd'+str(ccd)] = 1000 * (1 + 0.05 * np.sin(wave / 30)) + rng.normal(size=len(wave))
+        spectrum['counts_unc_ccd'+str(ccd)] = np.full(len(wave), 10.)
+        spectrum['lsf_ccd'+str(ccd)] = 0.12 + 0.01 * np.sin(wave / 50)
+        spectrum['lsf_b_ccd'+str(ccd)] = 2.2
+
+    saved = {name: getattr(af, name, None) for name in ['default_model_wave', 'model_components', 'initial_l', 'degradation_operators', 'batched_convolution_layout',
+                                                  'emulator_output_pixels', 'degradation_grid_cache_directory', 'renormalisation_states']}
+
+    af.degradation_grid_cache_directory = None
+    af.default_model_wave = default_model_wave
+    af.model_components = model_components
+    af.initial_l = af.calculate_default_degrading_wavelength_grid(default_model_wave, spectrum)
+    af.degradation_operators = af.build_degradation_operators(default_model_wave, spectrum, af.initial_l, rv_margin=af.pruning_rv_margin)
+    af.batched_convolution_layout = None
+    af.emulator_output_pixels = af.prune_emulator_output(af.degradation_operators)
+    af.renormalisation_states = dict()
+
+    scaled_labels = np.array([[0.1, 0.3, -0.1, 0.2, -0.3], [-0.2, 0.35, -0.1, 0.1, -0.1]])
+
+    yield spectrum, scaled_labels
+
+    for name, value in saved.items():
+        setattr(af, name, value)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+
+def test_batched_broadening_matches_per_ccd(af, pipeline, monkeypatch):
+    spectrum, scaled_labels = pipeline
+    model_fluxes = af.get_spectra_from_neural_net(scaled_labels.astype(af.model_precision), af.emulator_components())
+
+    # The CCDs are packed into rows of one array. Too little padding lets the kernel wrap from one end of a row onto the other, which shows at the ends of the degradation grid.
+    monkeypatch.setattr(af, 'batched_convolution_layout', af.build_batched_convolution(af.degradation_operators, spectrum['available_ccds']))
+    monkeypatch.setattr(af, 'convolution_workers', 2)
+    batched = af.apply_batched_degradation(model_fluxes)
+
+    for ccd in spectrum['available_ccds']:
+        reference = af.apply_degradation_operator(af.degradation_operators['ccd'+str(ccd)], model_fluxes)
+        np.testing.assert_allclose(batched['ccd'+str(ccd)], reference, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('rv_derivative', [False, True])
+def test_batched_convolution_matches_per_ccd(af, pipeline, monkeypatch, rv_derivative):
+    spectrum, scaled_labels = pipeline
+    model_fluxes = af.get_spectra_from_neural_net(scaled_labels.astype(af.model_precision), af.emulator_components())
+    rvs = [12., -25.]
+
+    monkeypatch.setattr(af, 'batched_convolution_layout', None)
+    reference = [af.degrade_to_observed_wavelength(spectrum, ccd, model_fluxes, rvs, rv_derivative) for ccd in spectrum['available_ccds']]
+
+    monkeypatch.setattr(af, 'batched_convolution_layout', af.build_batched_convolution(af.degradation_operators, spectrum['available_ccds']))
+    monkeypatch.setattr(af, 'convolution_workers', 2)
+    batched = af.degrade_to_observed_wavelength_all_ccds(spectrum, model_fluxes, rvs, rv_derivative)
+
+    assert len(batched) == len(reference)
+    for batched_ccd, reference_ccd in zip(batched, reference):
+        np.testing.assert_allclose(batched_ccd, reference_ccd, rtol=0, atol=1e-10)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+
+@pytest.mark.parametrize('precision, tolerance', [(np.float64, 1e-12), (np.float32, 1e-5)])
+def test_compiled_backend_matches_numpy(af, pipeline, monkeypatch, precision, tolerance):
+    spectrum, scaled_labels = pipeline
+    monkeypatch.setattr(af, 'model_precision', precision)
+    model_fluxes = af.get_spectra_from_neural_net(scaled_labels.astype(precision), af.emulator_components())
+
+    assert af.compiled_backend_available(spectrum)
+
+    for rvs, f_contr in [([12., -25.], 0.6), ([-150., 90.], 0.3)]:
+        monkeypatch.setattr(af, 'model_backend', 'numpy')
+        reference = af.combine_component_fluxes(spectrum, model_fluxes, rvs, f_contr)
+        compiled = af.combine_component_fluxes_compiled(spectrum, model_fluxes, rvs, f_contr)
+
+        assert sorted(compiled) == sorted(reference)
+        for key in reference:
+            np.testing.assert_allclose(compiled[key], reference[key], rtol=0, atol=tolerance)
+
+
+def test_spectrum_keeps_model_flux_of_its_evaluation(af, stellarmodel, pipeline, monkeypatch):
+    spectrum, scaled_labels = pipeline
+    monkeypatch.setattr(af, 'model_backend', 'numba')
+
+    model = stellarmodel.StellarModel()
+    for label, values in {'rv': (12., -25.), 'teff': (5.8, 4.9), 'logg': (4.2, 4.5), 'fe_h': (-0.2, -0.1), 'vmic': (1.3, 1.1), 'vsini': (6., 4.)}.items():
+        model.params[label + '_1'], model.params[label + '_2'] = values
+    model.params['f_contr'] = 0.6
+    af.create_synthetic_binary_spectrum_at_observed_wavelength(model, spectrum, same_fe_h=False)
+    model_flux = {ccd: np.array(spectrum['flux_model_ccd'+str(ccd)]) for ccd in spectrum['available_ccds']}
+
+    # Another evaluation reuses the output buffers of the compiled backend
+    af.combine_component_fluxes(spectrum, af.get_spectra_from_neural_net(scaled_labels, af.emulator_components()), [-150., 90.], 0.3)
+
+    for ccd in spectrum['available_ccds']:
+        np.testing.assert_array_equal(spectrum['flux_model_ccd'+str(ccd)], model_flux[ccd])
@@ -0,0 +1,29 @@
+import numpy as np
+
+
+def ragged_interpolator(af):
+    # Younger isochrones reach higher masses
+    log_ages, m_hs = np.array([8.5, 9.0, 9.5]), np.array([-0.1, 0.0, 0.1])
+    masses, values = [], []
+    for log_age in log_ages:
+        for m_h in m_hs:
+            isochrone_masses = np.linspace(0.5, 3.0 if log_age < 9.5 else 2.0, 11)
+            masses.append(isochrone_masses)
+            values.append(np.array([3.7 + 0.1 * isochrone_masses - 0.01 * log_age + 0.1 * m_h, 4.5 - 0.3 * isochrone_masses, 2 * isochrone_masses + 0.1 * log_age]).T)
+    offsets = np.concatenate([[0], np.cumsum([len(isochrone_masses) for isochrone_masses in masses])])
+    return af.IsochroneInterpolator(log_ages, m_hs, offsets, np.concatenate(masses), np.concatenate(values))
+
+
+def test_isochrone_interpolation_on_grid_points(af):
+    interpolator = ragged_interpolator(af)
+
+    # On the grid in log(age) and m_h, the neighbouring isochrone at log(age) = 9.5 does not reach the mass
+    np.testing.assert_allclose(interpolator(2.15, 9.0, 0.0), [3.7 + 0.215 - 0.09, 4.5 - 0.645, 4.3 + 0.9])
+    np.testing.assert_allclose(interpolator(2.15, 9.0, 0.0), interpolator(2.15, 9.0 - 1e-9, 0.0), atol=1e-8)
+    np.testing.assert_allclose(interpolator(2.15, 8.5, -0.1), [3.7 + 0.215 - 0.085 - 0.01, 4.5 - 0.645, 4.3 + 0.85])
+
+    # Outside of the grid or of the mass range of the isochrones the interpolation is still NaN
+    assert np.all(np.isnan(interpolator(2.15, 9.25, 0.0)))
+    assert np.all(np.isnan(interpolator(1.0, 9.6, 0.0)))
+    assert np.all(np.isnan(interpolator(1.0, 9.0, 0.2)))
+    assert np.all(np.isnan(interpolator(3.5, 9.0, 0.0)))
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+
+def isochrone_interpolator(af):
+    # Isochrones linear in mass on a 3x3 grid in log(age) and m_h, so that the interpolation has no kinks within a cell
+    log_ages, m_hs = np.array([9.0, 9.5, 10.0]), np.array([-0.5, 0.0, 0.5])
+    masses = np.linspace(0.6, 2.0, 15)
+    values = [
+        np.array([3.76 + 0.08 * (masses - 1) - 0.02 * (log_age - 9.5) - 0.01 * m_h, 4.4 - 0.4 * (masses - 1) - 0.1 * (log_age - 9.5) + 0.05 * m_h,
+                  2.5 * (masses - 1) + 0.2 * (log_age - 9.5) - 0.1 * m_h]).T
+        for log_age in log_ages for m_h in m_hs
+    ]
+    offsets = np.arange(len(log_ages) * len(m_hs) + 1) * len(masses)
+    return af.IsochroneInterpolator(log_ages, m_hs, offsets, np.tile(masses, len(log_ages) * len(m_hs)), np.concatenate(values))
+
+
+def binary_model(af, stellarmodel, isochrone, interpolate_flux):
+    if isochrone:
+        model = stellarmodel.StellarModel(labels=['mass', 'age', 'metallicity', 'rv', 'fe_h', 'vmic', 'vsini'], fixed_labels=['age', 'metallicity'],
+                                          interpolator=isochrone_interpolator(af), interpolate_flux=interpolate_flux)
+        model.params['mass_1'], model.params['mass_2'] = 1.2, 0.9
+        model.set_param('age', 3.)
+        model.set_param('metallicity', 0.1)
+    else:
+        model = stellarmodel.StellarModel()
+        model.params['teff_1'], model.params['teff_2'] = 5.8, 4.9
+        model.params['logg_1'], model.params['logg_2'] = 4.2, 4.5
+
+    model.params['f_contr'] = 0.6
+    model.params['rv_1'], model.params['rv_2'] = 12., -25.
+    model.params['fe_h_1'], model.params['fe_h_2'] = -0.2, -0.1
+    model.params['vmic_1'], model.params['vmic_2'] = 1.3, 1.1
+    model.params['vsini_1'], model.params['vsini_2'] = 6., 4.
+    return model
+
+
+def central_differences(model, function, steps):
+    parameters = model.get_params(values_only=True, exclude_fixed=True)
+    columns = []
+    for index, step in enumerate(steps):
+        values = []
+        for sign in [1, -1]:
+            model.set_params(parameters + sign * step * np.eye(len(parameters))[index])
+            values.append(function())
+        columns.append((values[0] - values[1]) / (2 * step))
+    model.set_params(parameters)
+    return np.array(columns).T
+
+
+def fit_label_steps(model, scale=1.):
+    return [scale * (1e-3 if label[:-2] in ['rv', 'vsini'] else 1e-5) for label in model.get_fit_labels()]
+
+
+@pytest.mark.parametrize('isochrone, interpolate_flux', [(False, False), (True, False), (True, True)])
+def test_binary_flux_jacobian_matches_central_differences(af, stellarmodel, pipeline, isochrone, interpolate_flux):
+    spectrum, _ = pipeline
+    model = binary_model(af, stellarmodel, isochrone, interpolate_flux)
+
+    model_flux, jacobian = af.create_synthetic_binary_spectrum_and_jacobian(model, spectrum)
+    reference = central_differences(model, lambda: af.create_synthetic_binary_spectrum_at_observed_wavelength(model, spectrum, same_fe_h=False)[3].copy(), fit_label_steps(model))
+
+    assert jacobian.shape == reference.shape
+    scale = np.maximum(np.max(np.abs(reference), axis=0), 1e-8)
+    assert np.max(np.abs(jacobian - reference) / scale) < 1e-4
+
+
+@pytest.mark.parametrize('renormalisation_mode', ['cached', None])
+def test_rchi2_gradient_matches_central_differences(af, stellarmodel, pipeline, monkeypatch, renormalisation_mode):
+    spectrum, _ = pipeline
+    monkeypatch.setattr(af, 'renormalisation_mode', renormalisation_mode)
+    model = binary_model(af, stellarmodel, False, False)
+
+    def rchi2():
+        model.generate_model(spectrum)
+        return model.get_rchi2()
+
+    # The Chebyshev fit on the unscaled wavelengths leaves rounding errors of ~1e-7 in the continuum, so small steps only difference noise
+    reference = central_differences(model, rchi2, fit_label_steps(model, scale=300.))
+    value, gradient = af.get_rchi2_and_gradient(model, spectrum)
+    assert value == pytest.approx(rchi2(), rel=1e-10)
+
+    # Without the renormalisation term the deviation is a few 1e-3
+    assert np.max(np.abs(gradient - reference)) < 1e-3 * np.max(np.abs(reference))
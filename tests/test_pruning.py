@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+
+def binary_flux(af, spectrum, scaled_labels, rvs):
+    model_fluxes = af.get_spectra_from_neural_net(scaled_labels.astype(af.model_precision), af.emulator_components())
+    # Copies, as the compiled backend reuses its output buffers
+    return {key: np.array(flux) for key, flux in af.combine_component_fluxes(spectrum, model_fluxes, rvs, 0.6).items()}
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_pruned_emulator_output_matches_full_grid(af, pipeline, monkeypatch, backend):
+    spectrum, scaled_labels = pipeline
+    if backend == 'numba':
+        pytest.importorskip('numba')
+    monkeypatch.setattr(af, 'model_backend', backend)
+    rvs = [60., -90.]
+
+    monkeypatch.setattr(af, 'degradation_operators', af.build_degradation_operators(af.default_model_wave, spectrum, af.initial_l))
+    monkeypatch.setattr(af, 'emulator_output_pixels', None)
+    reference = binary_flux(af, spectrum, scaled_labels, rvs)
+
+    monkeypatch.setattr(af, 'degradation_operators', af.build_degradation_operators(af.default_model_wave, spectrum, af.initial_l, rv_margin=100.))
+    monkeypatch.setattr(af, 'emulator_output_pixels', af.prune_emulator_output(af.degradation_operators))
+
+    # The margin of 100 km/s leaves out the edges of every CCD
+    n_pixels = sum(pixels.stop - pixels.start for pixels in af.emulator_output_pixels)
+    assert n_pixels < 0.95 * len(af.default_model_wave)
+    assert af.emulator_components()[2][0].shape[0] == af.emulator_output_pixels[0].stop - af.emulator_output_pixels[0].start
+
+    pruned = binary_flux(af, spectrum, scaled_labels, rvs)
+    for key in reference:
+        np.testing.assert_allclose(pruned[key], reference[key], rtol=0, atol=1e-10)
+
+    # Beyond the margin the resampling would extrapolate
+    with pytest.raises(ValueError, match='outside'):
+        binary_flux(af, spectrum, scaled_labels, [150., -90.])
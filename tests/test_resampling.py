@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def model_fluxes(af, scaled_labels):
+    return af.get_spectra_from_neural_net(scaled_labels.astype(af.model_precision), af.emulator_components())
+
+
+def test_lagrange_resampling_matches_cubic_spline(af, pipeline):
+    spectrum, scaled_labels = pipeline
+
+    # Flux of the local Lagrange resampling against the cubic spline through the whole degradation grid
+    for rvs in [[12., -25.], [-180., 150.]]:
+        deviations = af.validate_resampling(spectrum, model_fluxes(af, scaled_labels), rvs, threshold=1e-6)
+        assert sorted(deviations) == ['ccd1', 'ccd2', 'ccd3', 'ccd4']
+        assert max(deviations.values()) < 1e-6
+
+
+def test_lagrange_resampling_rv_derivative(af, pipeline, monkeypatch):
+    spectrum, scaled_labels = pipeline
+    fluxes = model_fluxes(af, scaled_labels)
+
+    monkeypatch.setattr(af, 'resampling_points', None)
+    _, reference = af.degrade_to_observed_wavelength_fused(spectrum, 2, fluxes, [12., -25.], rv_derivative=True)
+    monkeypatch.setattr(af, 'resampling_points', 6)
+    _, derivative = af.degrade_to_observed_wavelength_fused(spectrum, 2, fluxes, [12., -25.], rv_derivative=True)
+
+    assert np.max(np.abs(derivative - reference)) < 1e-3 * np.max(np.abs(reference))
+
+
+def test_float32_matches_float64(af, pipeline, monkeypatch):
+    spectrum, scaled_labels = pipeline
+
+    model_flux = dict()
+    for precision in [np.float64, np.float32]:
+        monkeypatch.setattr(af, 'model_precision', precision)
+        # Copies, as the compiled backend reuses its output buffers
+        model_flux[precision] = {key: np.array(flux) for key, flux in af.combine_component_fluxes(spectrum, model_fluxes(af, scaled_labels), [12., -25.], 0.6).items()}
+
+    for key in model_flux[np.float64]:
+        np.testing.assert_allclose(model_flux[np.float32][key], model_flux[np.float64][key], rtol=0, atol=1e-5)
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+
+def median_fit(p, ye, mask):
+    return np.full(len(p[0]), np.median(p[1][mask]))
+
+
+@pytest.mark.parametrize('dim', [6, 40])
+def test_sclip_grow_rejects_neighbours(af, dim):
+    x = np.arange(dim, dtype=float)
+    y = np.ones(dim) + 0.01 * np.sin(x)
+    y[1] = 5.
+
+    # Fewer points than the 2 * grow + 1 wide window for dim = 6
+    mask = af.sclip((x, y), median_fit, 3, ye=np.full(dim, 0.1), sl=1, su=1, grow=3, verbose=False)[2]
+
+    expected = np.ones(dim, dtype=bool)
+    expected[:5] = False
+    assert np.array_equal(mask, expected)
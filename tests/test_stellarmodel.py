@@ -0,0 +1,31 @@
+import numpy as np
+
+
+def test_labels_added_after_construction(stellarmodel):
+    model = stellarmodel.StellarModel(fixed_labels=['vmic'])
+    for index, label in enumerate(model.params):
+        model.params[label] = index
+
+    # A new label through the mapping, and enough new ones to outgrow the initial capacity of the parameter array
+    model.params['extra_1'] = 100.
+    for index in range(40):
+        model.add_param('label' + str(index), float(index))
+
+    labels = list(model.params)
+    assert len(model.params.array) == len(labels)
+    assert np.array_equal(model.fit_mask, [label.split('_')[0] != 'vmic' for label in labels])
+    assert np.array_equal(model.get_params(values_only=True, exclude_fixed=True), [model.params[label] for label in labels if label.split('_')[0] != 'vmic'])
+
+    for component in [1, 2]:
+        component_labels = [label for label in labels if label.split('_')[-1] == str(component)]
+        assert np.array_equal(model.get_component_params(component, values_only=True), [model.params[label] for label in component_labels])
+
+    assert model.get_component_params(2)['label39'] == 39.
+
+    # Setting the fitted parameters as an array writes into the current array
+    values = np.arange(np.count_nonzero(model.fit_mask), dtype=float) + 0.5
+    model.set_params(values)
+    assert np.array_equal(model.get_params(values_only=True, exclude_fixed=True), values)
+
+    del model.params['extra_1']
+    assert np.array_equal(model.get_component_params(1, values_only=True), [model.params[label] for label in model.params if label.endswith('_1')])